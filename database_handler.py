@@ -1,14 +1,30 @@
+import csv
+import hashlib
+import io
 import logging
 import os
 import random
 import psycopg2
 
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from contextlib import contextmanager
-from typing import Generator
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Generator, Iterator
 
 from stocks_handler import Stock, StockQuality
 from utils import ExistingStock
+from valuation_grid import ScenarioGrid, ValuationGridResult, ValuationInputs
+
+
+@dataclass
+class SymbolSnapshot:
+    exchange: str
+    content_hash: str
+    file_mtime: float
+    file_size: int
+    symbols: set[str] = field(default_factory=set)
+    id: int | None = None
 
 
 class DatabaseHandler:
@@ -17,14 +33,76 @@ class DatabaseHandler:
     DB_NAME = os.getenv("DATABASE_NAME", "database")
     DB_USER = os.getenv("DATABASE_USER", "postgres")
     DB_PASSWORD = os.getenv("DATABASE_PASSWORD", "password")
+    DB_CONNECT_TIMEOUT = os.getenv("DATABASE_CONNECT_TIMEOUT", "10")  # Seconds
     EXCHANGE_FILES_DIRECTORY = os.getenv("EXCHANGE_FILES_DIRECTORY", "Symbol Files")
+    HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+    SYMBOL_PAGE_SIZE = int(os.getenv("SYMBOL_PAGE_SIZE", "1000"))
+    HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))  # 0 keeps all
+    HISTORY_COLUMNS = (
+        "run_date",
+        "recorded_at",
+        "symbol",
+        "exchange",
+        "quality",
+        "current",
+        "pe",
+        "dcf",
+        "roe",
+        "growth_estimate",
+        "current_eps",
+        "historical_pe",
+        "historical_roe",
+        "fcf",
+        "shares_outstanding",
+        "stockholders_equity",
+        "cash",
+        "liabilities",
+        "trailing_dividend_rate",
+    )
 
-    def __init__(self):
+    # Margin of safety is 1 - price / value, positive when the stock trades below the value
+    # NaN is greater than every number in Postgres, NaN values get no margin
+    RANKING_SELECT = """SELECT
+        s.id, s.symbol, s.exchange, s.quality, s.current, s.pe, s.dcf, s.roe,
+        m.pe_margin, m.dcf_margin, m.roe_margin,
+        GREATEST(m.pe_margin, m.dcf_margin, m.roe_margin), NOW()
+        FROM stocks s
+        CROSS JOIN LATERAL (SELECT
+            CASE WHEN s.pe > 0 AND s.pe <> 'NaN' AND s.current > 0 AND s.current <> 'NaN'
+                THEN 1 - s.current / s.pe END AS pe_margin,
+            CASE WHEN s.dcf > 0 AND s.dcf <> 'NaN' AND s.current > 0 AND s.current <> 'NaN'
+                THEN 1 - s.current / s.dcf END AS dcf_margin,
+            CASE WHEN s.roe > 0 AND s.roe <> 'NaN' AND s.current > 0 AND s.current <> 'NaN'
+                THEN 1 - s.current / s.roe END AS roe_margin
+        ) m"""
+    RANKING_UPSERT = """INSERT INTO stock_rankings(
+        stock_id, symbol, exchange, quality, current, pe, dcf, roe,
+        pe_margin, dcf_margin, roe_margin, best_margin, updated_at
+        ) {select}
+        ON CONFLICT (symbol, exchange) DO UPDATE SET
+        stock_id=EXCLUDED.stock_id, quality=EXCLUDED.quality, current=EXCLUDED.current,
+        pe=EXCLUDED.pe, dcf=EXCLUDED.dcf, roe=EXCLUDED.roe,
+        pe_margin=EXCLUDED.pe_margin, dcf_margin=EXCLUDED.dcf_margin,
+        roe_margin=EXCLUDED.roe_margin, best_margin=EXCLUDED.best_margin,
+        updated_at=EXCLUDED.updated_at"""
+
+    def __init__(self, require_connection: bool = True):
         self.connection_string = self.create_connection_string()
-        self.test_connection()
+        self.symbol_snapshots: dict[str, SymbolSnapshot] = {}
+        self.run_date = date.today()
+        self.history_buffer: list[tuple] = []
+        self.tables_ready = False
+        try:
+            self.test_connection()
+            self.create_fetcher_tables()
+            self.tables_ready = True
+        except psycopg2.Error:
+            if require_connection:
+                raise
+            logging.warning("Database unavailable, continuing without it")
 
     def create_connection_string(self) -> str:
-        return f"host={self.DB_HOST} port={self.DB_PORT} dbname={self.DB_NAME} user={self.DB_USER} password={self.DB_PASSWORD}"
+        return f"host={self.DB_HOST} port={self.DB_PORT} dbname={self.DB_NAME} user={self.DB_USER} password={self.DB_PASSWORD} connect_timeout={self.DB_CONNECT_TIMEOUT}"
 
     def test_connection(self) -> None:
         """Test the connection to the PostgreSQL database."""
@@ -37,6 +115,142 @@ class DatabaseHandler:
             logging.error(f"Error connecting to the database")
             raise e
 
+    def create_fetcher_tables(self) -> None:
+        """Create the tables owned by the fetcher if they do not exist yet.
+
+        The stocks and news tables belong to the Intrinsic schema, anything the
+        fetcher needs for its own bookkeeping lives in separate tables.
+        """
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS symbol_snapshots (
+                    id SERIAL PRIMARY KEY,
+                    exchange TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    file_mtime DOUBLE PRECISION NOT NULL,
+                    file_size BIGINT NOT NULL,
+                    symbols TEXT[] NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    )"""
+                )
+                cur.execute(
+                    """CREATE INDEX IF NOT EXISTS symbol_snapshots_exchange_idx
+                    ON symbol_snapshots (exchange, id DESC)"""
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS inactive_symbols (
+                    symbol TEXT NOT NULL,
+                    exchange TEXT NOT NULL,
+                    snapshot_id INTEGER REFERENCES symbol_snapshots(id),
+                    removed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (symbol, exchange)
+                    )"""
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS valuation_scenarios (
+                    scenario INTEGER PRIMARY KEY,
+                    discount_rate REAL NOT NULL,
+                    margin_of_safety REAL NOT NULL,
+                    growth_haircut REAL NOT NULL
+                    )"""
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS valuation_grid (
+                    symbol TEXT NOT NULL,
+                    exchange TEXT NOT NULL,
+                    pe REAL[] NOT NULL,
+                    roe REAL[] NOT NULL,
+                    dcf REAL[] NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (symbol, exchange)
+                    )"""
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS stock_rankings (
+                    stock_id INTEGER NOT NULL,
+                    symbol TEXT NOT NULL,
+                    exchange TEXT NOT NULL,
+                    quality INTEGER,
+                    current DOUBLE PRECISION,
+                    pe DOUBLE PRECISION,
+                    dcf DOUBLE PRECISION,
+                    roe DOUBLE PRECISION,
+                    pe_margin DOUBLE PRECISION,
+                    dcf_margin DOUBLE PRECISION,
+                    roe_margin DOUBLE PRECISION,
+                    best_margin DOUBLE PRECISION,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (symbol, exchange)
+                    )"""
+                )
+                cur.execute(
+                    """CREATE INDEX IF NOT EXISTS stock_rankings_screen_idx
+                    ON stock_rankings (quality, best_margin DESC NULLS LAST)"""
+                )
+                cur.execute(
+                    """CREATE INDEX IF NOT EXISTS stock_rankings_exchange_screen_idx
+                    ON stock_rankings (exchange, quality, best_margin DESC NULLS LAST)"""
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS stock_history (
+                    run_date DATE NOT NULL,
+                    recorded_at TIMESTAMP NOT NULL,
+                    symbol TEXT NOT NULL,
+                    exchange TEXT NOT NULL,
+                    quality INTEGER,
+                    current DOUBLE PRECISION,
+                    pe DOUBLE PRECISION,
+                    dcf DOUBLE PRECISION,
+                    roe DOUBLE PRECISION,
+                    growth_estimate DOUBLE PRECISION,
+                    current_eps DOUBLE PRECISION,
+                    historical_pe DOUBLE PRECISION,
+                    historical_roe DOUBLE PRECISION,
+                    fcf DOUBLE PRECISION,
+                    shares_outstanding DOUBLE PRECISION,
+                    stockholders_equity DOUBLE PRECISION,
+                    cash DOUBLE PRECISION,
+                    liabilities DOUBLE PRECISION,
+                    trailing_dividend_rate DOUBLE PRECISION
+                    ) PARTITION BY RANGE (run_date)"""
+                )
+                cur.execute(
+                    """CREATE INDEX IF NOT EXISTS stock_history_symbol_idx
+                    ON stock_history (symbol, exchange, run_date)"""
+                )
+                cur.execute("SELECT 1 FROM stock_rankings LIMIT 1")
+                if cur.fetchone() is None:
+                    # One time backfill, afterwards rows are refreshed as stocks are updated
+                    cur.execute(
+                        self.RANKING_UPSERT.format(
+                            select=self.RANKING_SELECT
+                            + """ WHERE NOT EXISTS (
+                                SELECT 1 FROM inactive_symbols i
+                                WHERE i.symbol = s.symbol AND i.exchange = s.exchange
+                            )"""
+                        )
+                    )
+                conn.commit()
+        except psycopg2.Error as e:
+            logging.error(f"Error creating fetcher tables: {e}")
+            raise e
+
+    def ensure_fetcher_tables(self) -> bool:
+        """Create the fetcher tables if that failed at startup.
+
+        Returns:
+            bool: False while the database is still unavailable.
+        """
+        if not self.tables_ready:
+            try:
+                self.create_fetcher_tables()
+                self.tables_ready = True
+            except psycopg2.Error:
+                return False
+        return True
+
     @contextmanager
     def connect_to_database(
         self,
@@ -72,9 +286,176 @@ class DatabaseHandler:
 
         return symbols
 
+    def fetch_latest_symbol_snapshot(self, exchange: str) -> SymbolSnapshot | None:
+        """Fetch the most recent symbol snapshot stored for an exchange."""
+        query = """SELECT id, content_hash, file_mtime, file_size, symbols
+            FROM symbol_snapshots WHERE exchange=%s ORDER BY id DESC LIMIT 1"""
+        result = self.execute_query(query, (exchange,), fetchone=True)
+        if not result:
+            return None
+        return SymbolSnapshot(
+            exchange=exchange,
+            content_hash=result["content_hash"],
+            file_mtime=result["file_mtime"],
+            file_size=result["file_size"],
+            symbols=set(result["symbols"]),
+            id=result["id"],
+        )
+
+    def load_symbol_snapshot(self, exchange: str) -> SymbolSnapshot | None:
+        """Load the symbol snapshot for an exchange file.
+
+        The file is only read when its mtime or size differ from the last
+        snapshot, and only reparsed when its content hash differs as well. A
+        changed file is stored as a new snapshot and diffed against the
+        previous one so that removed symbols are marked inactive.
+
+        Args:
+            exchange (str): Exchange name, matching the file name without extension.
+
+        Returns:
+            SymbolSnapshot | None: The current snapshot, or None if the file could not be read.
+        """
+        full_path = os.path.join(self.EXCHANGE_FILES_DIRECTORY, f"{exchange}.txt")
+        try:
+            file_stat = os.stat(full_path)
+        except OSError as e:
+            logging.error(f"Error reading file {full_path}: {e}")
+            return None
+
+        previous = self.symbol_snapshots.get(
+            exchange
+        ) or self.fetch_latest_symbol_snapshot(exchange)
+        if (
+            previous
+            and previous.file_mtime == file_stat.st_mtime
+            and previous.file_size == file_stat.st_size
+        ):
+            self.symbol_snapshots[exchange] = previous
+            return previous
+
+        try:
+            with open(full_path, "rb") as file:
+                content = file.read()
+        except IOError as e:
+            logging.error(f"Error reading file {full_path}: {e}")
+            return None
+
+        content_hash = hashlib.sha256(content).hexdigest()
+        if previous and previous.content_hash == content_hash:
+            previous.file_mtime = file_stat.st_mtime
+            previous.file_size = file_stat.st_size
+            self.execute_update(
+                "UPDATE symbol_snapshots SET file_mtime=%s, file_size=%s WHERE id=%s",
+                (previous.file_mtime, previous.file_size, previous.id),
+            )
+            self.symbol_snapshots[exchange] = previous
+            return previous
+
+        snapshot = SymbolSnapshot(
+            exchange=exchange,
+            content_hash=content_hash,
+            file_mtime=file_stat.st_mtime,
+            file_size=file_stat.st_size,
+            symbols={
+                line.strip()
+                for line in content.decode("utf-8", errors="ignore").splitlines()
+                if line.strip()
+            },
+        )
+        self.save_symbol_snapshot(snapshot, previous)
+        self.symbol_snapshots[exchange] = snapshot
+        return snapshot
+
+    def save_symbol_snapshot(
+        self, snapshot: SymbolSnapshot, previous: SymbolSnapshot | None
+    ) -> None:
+        """Store a new snapshot and apply its diff against the previous one.
+
+        The first snapshot of an exchange is diffed against the exchange's
+        rows in the stocks table instead, so symbols that left the file
+        before snapshots were kept are marked inactive as well.
+        """
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                if previous:
+                    previous_symbols = previous.symbols
+                else:
+                    cur.execute(
+                        "SELECT symbol FROM stocks WHERE exchange=%s",
+                        (snapshot.exchange,),
+                    )
+                    previous_symbols = {row[0] for row in cur.fetchall()}
+                added = snapshot.symbols - previous_symbols
+                removed = previous_symbols - snapshot.symbols
+
+                cur.execute(
+                    """INSERT INTO symbol_snapshots(
+                    exchange, content_hash, file_mtime, file_size, symbols
+                    ) VALUES (%s, %s, %s, %s, %s) RETURNING id""",
+                    (
+                        snapshot.exchange,
+                        snapshot.content_hash,
+                        snapshot.file_mtime,
+                        snapshot.file_size,
+                        sorted(snapshot.symbols),
+                    ),
+                )
+                snapshot.id = cur.fetchone()[0]
+                if removed:
+                    cur.executemany(
+                        """INSERT INTO inactive_symbols(symbol, exchange, snapshot_id)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (symbol, exchange) DO NOTHING""",
+                        [(symbol, snapshot.exchange, snapshot.id) for symbol in removed],
+                    )
+                    cur.execute(
+                        "DELETE FROM stock_rankings WHERE exchange=%s AND symbol = ANY(%s)",
+                        (snapshot.exchange, list(removed)),
+                    )
+                if added:
+                    cur.executemany(
+                        "DELETE FROM inactive_symbols WHERE symbol=%s AND exchange=%s",
+                        [(symbol, snapshot.exchange) for symbol in added],
+                    )
+                conn.commit()
+            logging.info(
+                f"New {snapshot.exchange} symbol snapshot: {len(added)} added, {len(removed)} removed"
+            )
+        except psycopg2.Error as e:
+            logging.error(f"Error saving symbol snapshot for {snapshot.exchange}: {e}")
+
+    def load_symbol_universe(self, exchanges: list[str]) -> list[tuple[str, str]]:
+        """Load the current symbol universe from the exchange file snapshots."""
+        if not os.path.exists(self.EXCHANGE_FILES_DIRECTORY):
+            raise FileNotFoundError(
+                f"Directory {self.EXCHANGE_FILES_DIRECTORY} not found."
+            )
+
+        symbols = []
+        for exchange in exchanges:
+            snapshot = self.load_symbol_snapshot(exchange)
+            if snapshot:
+                symbols.extend((symbol, exchange) for symbol in snapshot.symbols)
+
+        return symbols
+
+    def execute_update(self, query: str, params: tuple = ()) -> bool:
+        """Execute a write query and commit it."""
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                cur.execute(query, params)
+                conn.commit()
+            return True
+        except psycopg2.Error as e:
+            logging.error(f"Database update failed: {e}")
+            return False
+
     def update_stock_symbols_from_files(self, file_paths: list[str]) -> None:
         """Update the stocks table with symbols from exchange files."""
-        all_symbols = self.read_symbols_from_files(file_paths)
+        all_symbols = self.load_symbol_universe(file_paths)
 
         try:
             with self.connect_to_database() as conn:
@@ -98,7 +479,7 @@ class DatabaseHandler:
 
     def fetch_new_symbols(self, local_exchange_list: list[str]) -> set[tuple[str, str]]:
         """Get new symbols from the exchange files."""
-        all_symbols = set(self.read_symbols_from_files(local_exchange_list))
+        all_symbols = set(self.load_symbol_universe(local_exchange_list))
         query = """SELECT symbol, exchange FROM stocks"""
 
         try:
@@ -112,8 +493,12 @@ class DatabaseHandler:
         return new_symbols
 
     def fetch_existing_symbols(self) -> set[tuple[str, str]]:
-        """Get existing symbols from the stocks table."""
-        query = """SELECT symbol, exchange FROM stocks"""
+        """Get existing symbols from the stocks table, skipping inactive ones."""
+        query = """SELECT s.symbol, s.exchange FROM stocks s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM inactive_symbols i
+                WHERE i.symbol = s.symbol AND i.exchange = s.exchange
+            )"""
 
         try:
             results = self.execute_query(query, ())
@@ -124,6 +509,65 @@ class DatabaseHandler:
 
         return existing_symbols
 
+    def iter_new_symbols(self, exchanges: list[str]) -> Iterator[tuple[str, str]]:
+        """Yield the exchange file symbols missing from the stocks table.
+
+        The stocks table is checked a page of SYMBOL_PAGE_SIZE symbols at a
+        time as the symbols are consumed, instead of loading every stored
+        symbol up front.
+        """
+        universe = sorted(set(self.load_symbol_universe(exchanges)))
+        query = """SELECT s.symbol, s.exchange FROM stocks s
+            JOIN unnest(%s::text[], %s::text[]) AS p(symbol, exchange)
+            ON s.symbol = p.symbol AND s.exchange = p.exchange"""
+
+        for start in range(0, len(universe), self.SYMBOL_PAGE_SIZE):
+            page = universe[start : start + self.SYMBOL_PAGE_SIZE]
+            results = self.execute_query(
+                query,
+                ([symbol for symbol, _ in page], [exchange for _, exchange in page]),
+            )
+            existing_symbols = set((row[0], row[1]) for row in results or [])
+            yield from (item for item in page if item not in existing_symbols)
+
+    def fetch_stock_exchanges(self) -> list[str]:
+        """Get the exchanges of the stocks table."""
+        results = self.execute_query("SELECT DISTINCT exchange FROM stocks", ())
+        return [row[0] for row in results or []]
+
+    def iter_existing_symbols(
+        self, exchange: str | None = None
+    ) -> Iterator[tuple[str, str]]:
+        """Yield the active symbols of the stocks table a page at a time.
+
+        Pages are read with keyset pagination on (symbol, exchange), so no
+        transaction stays open between pages.
+
+        Args:
+            exchange (str | None, optional): Only yield symbols of this exchange. Defaults to all exchanges.
+        """
+        query = """SELECT s.symbol, s.exchange FROM stocks s
+            WHERE (s.symbol, s.exchange) > (%s, %s)
+            AND NOT EXISTS (
+                SELECT 1 FROM inactive_symbols i
+                WHERE i.symbol = s.symbol AND i.exchange = s.exchange
+            )"""
+        if exchange:
+            query += " AND s.exchange = %s"
+        query += " ORDER BY s.symbol, s.exchange LIMIT %s"
+        filters = (exchange,) if exchange else ()
+
+        last_symbol = ("", "")
+        while True:
+            results = self.execute_query(
+                query, last_symbol + filters + (self.SYMBOL_PAGE_SIZE,)
+            )
+            if not results:
+                return
+            for row in results:
+                yield (row[0], row[1])
+            last_symbol = (results[-1][0], results[-1][1])
+
     def fetch_all_symbols(
         self,
         local_exchange_list: list[str],
@@ -265,8 +709,202 @@ class DatabaseHandler:
             logging.error(f"Error fetching stock: {e}")
             return None
 
-    def update_stock_in_database(self, stock: Stock) -> bool:
-        """Update or insert stock in the database."""
+    def get_undervalued_stocks(
+        self,
+        quality: StockQuality = StockQuality.OKAY,
+        exchange: str | None = None,
+        min_margin: float = 0.0,
+        limit: int = 100,
+    ) -> list[dict]:
+        """Get the most undervalued stocks from the precomputed rankings.
+
+        Args:
+            quality (StockQuality, optional): Maximum quality of stock to return. Defaults to StockQuality.OKAY.
+            exchange (str | None, optional): Only return stocks from this exchange. Defaults to all exchanges.
+            min_margin (float, optional): Minimum margin of safety (1 - price / value). Defaults to 0.0.
+            limit (int, optional): Maximum number of stocks to return. Defaults to 100.
+
+        Returns:
+            list[dict]: Ranking rows ordered by best margin of safety, largest first.
+        """
+        # Rows ranked before NaN values were excluded can still hold a NaN margin
+        query = """SELECT * FROM stock_rankings
+            WHERE quality <= %s AND best_margin >= %s AND best_margin <> 'NaN'"""
+        params = (quality.value, min_margin)
+        if exchange:
+            query += " AND exchange = %s"
+            params += (exchange,)
+        query += " ORDER BY best_margin DESC NULLS LAST LIMIT %s"
+        params += (limit,)
+
+        results = self.execute_query(query, params)
+        return results or []
+
+    def fetch_valuation_inputs(self) -> ValuationInputs | None:
+        """Fetch the stored valuation inputs of all active stocks as column arrays."""
+        query = """SELECT s.symbol, s.exchange, s.currenteps, s.historicalpe,
+            s.growthestimate, s.stockholdersequityraw, s.sharesoutstandingraw,
+            s.trailingdividendrateraw, s.historicalroe, s.fcfrawvalue,
+            s.cashraweq, s.liabilities
+            FROM stocks s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM inactive_symbols i
+                WHERE i.symbol = s.symbol AND i.exchange = s.exchange
+            )"""
+        results = self.execute_query(query, ())
+        if not results:
+            return None
+        return ValuationInputs.from_db_rows(results)
+
+    def save_valuation_grid(
+        self, grid: ScenarioGrid, result: ValuationGridResult
+    ) -> bool:
+        """Replace the valuation scenarios and the grid, one row of arrays per stock.
+
+        Array position i of pe, roe and dcf holds the value for scenario i.
+        Rows of stocks missing from the result are removed, their arrays
+        would not match the new scenarios.
+        """
+
+        def to_list(values) -> list[float | None]:
+            return [None if value != value else float(value) for value in values]
+
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM valuation_scenarios")
+                cur.execute("DELETE FROM valuation_grid")
+                execute_values(
+                    cur,
+                    """INSERT INTO valuation_scenarios(
+                    scenario, discount_rate, margin_of_safety, growth_haircut
+                    ) VALUES %s""",
+                    [
+                        (i, float(rate), float(margin), float(haircut))
+                        for i, (rate, margin, haircut) in enumerate(
+                            zip(
+                                grid.discount_rate,
+                                grid.margin_of_safety,
+                                grid.growth_haircut,
+                            )
+                        )
+                    ],
+                )
+                execute_values(
+                    cur,
+                    """INSERT INTO valuation_grid(symbol, exchange, pe, roe, dcf)
+                    VALUES %s
+                    ON CONFLICT (symbol, exchange) DO UPDATE SET
+                    pe=EXCLUDED.pe, roe=EXCLUDED.roe, dcf=EXCLUDED.dcf,
+                    updated_at=NOW()""",
+                    [
+                        (
+                            symbol,
+                            exchange,
+                            to_list(result.pe[i]),
+                            to_list(result.roe[i]),
+                            to_list(result.dcf[i]),
+                        )
+                        for i, (symbol, exchange) in enumerate(result.symbols)
+                    ],
+                    page_size=1000,
+                )
+                conn.commit()
+            return True
+        except psycopg2.Error as e:
+            logging.error(f"Valuation grid update failed: {e}")
+            return False
+
+    @staticmethod
+    def history_partition_name(run_date: date) -> str:
+        return f"stock_history_{run_date:%Y%m%d}"
+
+    def record_history(self, stock: Stock) -> None:
+        """Buffer a history row for the stock, loading the buffer once it is full."""
+
+        def number(value) -> float | None:
+            return value if isinstance(value, (int, float)) else None
+
+        stock_data = stock.stock_data
+        self.history_buffer.append(
+            (
+                self.run_date,
+                datetime.now(),
+                stock.symbol,
+                stock.exchange,
+                stock_data.quality.value,
+                number(stock_data.current_price),
+                number(stock_data.pe),
+                number(stock_data.dcf),
+                number(stock_data.roe),
+                number(stock_data.growth_estimate),
+                number(stock_data.current_eps),
+                number(stock_data.historical_pe),
+                number(stock_data.historical_roe),
+                number(stock_data.fcf_raw_value),
+                number(stock_data.shares_outstanding_raw),
+                number(stock_data.stockholders_equity_raw),
+                number(stock_data.cash_raw_eq),
+                number(stock_data.liabilities),
+                number(stock_data.trailing_dividend_rate_raw),
+            )
+        )
+        if len(self.history_buffer) >= self.HISTORY_BATCH_SIZE:
+            self.flush_history()
+
+    def flush_history(self) -> bool:
+        """Bulk load the buffered history rows into the run date partition with COPY."""
+        if not self.history_buffer:
+            return True
+
+        partition = self.history_partition_name(self.run_date)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(self.history_buffer)
+        buffer.seek(0)
+
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    f"""CREATE TABLE IF NOT EXISTS {partition}
+                    PARTITION OF stock_history
+                    FOR VALUES FROM (%s) TO (%s)""",
+                    (self.run_date, self.run_date + timedelta(days=1)),
+                )
+                cur.copy_expert(
+                    f"COPY {partition} ({', '.join(self.HISTORY_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    buffer,
+                )
+                conn.commit()
+            logging.info(f"Loaded {len(self.history_buffer)} rows into {partition}")
+            self.history_buffer = []
+            return True
+        except psycopg2.Error as e:
+            logging.error(f"History load failed: {e}")
+            return False
+
+    def drop_old_history_partitions(self) -> None:
+        """Drop history partitions older than the retention period."""
+        if self.HISTORY_RETENTION_DAYS <= 0:
+            return
+
+        cutoff = self.history_partition_name(
+            self.run_date - timedelta(days=self.HISTORY_RETENTION_DAYS)
+        )
+        query = """SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'stock_history'"""
+        results = self.execute_query(query, ()) or []
+        for row in results:
+            partition = row["relname"]
+            # Partition names sort by date, so older partitions compare lower
+            if partition < cutoff and self.execute_update(f"DROP TABLE {partition}"):
+                logging.info(f"Dropped history partition {partition}")
+
+    def write_stock(self, cur: psycopg2.extensions.cursor, stock: Stock) -> None:
+        """Write a stock, its ranking and its news without committing."""
 
         values = (
             stock.stock_data.current_price,
@@ -298,64 +936,129 @@ class DatabaseHandler:
             stock.symbol,
         )
 
-        try:
-            with self.connect_to_database() as conn:
-                cur = conn.cursor()
+        cur.execute(
+            "SELECT id FROM stocks WHERE symbol=%s AND exchange=%s",
+            (stock.symbol, stock.exchange),
+        )
+        stock_row = cur.fetchone()
+
+        if stock_row:
+            stock_id = stock_row[0]
+            cur.execute(
+                """UPDATE stocks SET 
+                current=%s, pe=%s, dcf=%s, roe=%s, exchange=%s,
+                title=COALESCE(%s, title), industry=COALESCE(%s, industry),
+                marketcap=%s, revenue=%s, netincome=%s, assets=%s, liabilities=%s, debt=%s,
+                esgscore=COALESCE(%s, esgscore), controversy=COALESCE(%s, controversy),
+                summary=COALESCE(%s, summary), longtermdebt=%s,
+                growthestimate=%s, currenteps=%s, historicalpe=%s, cashraweq=%s, fcfrawvalue=%s,
+                sharesoutstandingraw=%s, stockholdersequityraw=%s, historicalroe=%s,
+                trailingdividendrateraw=%s WHERE symbol=%s AND exchange=%s""",
+                values + (stock.exchange,),
+            )
+        else:
+            cur.execute(
+                """INSERT INTO stocks(
+                current, pe, dcf, roe, exchange, title, industry, marketcap,
+                revenue, netincome, assets, liabilities, debt, esgscore, controversy,
+                summary, longtermdebt, growthestimate, currenteps,
+                historicalpe, cashraweq, fcfrawvalue, sharesoutstandingraw,
+                stockholdersequityraw, historicalroe, trailingdividendrateraw, symbol
+                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+                values,
+            )
+            cur.execute(
+                "SELECT id FROM stocks WHERE symbol=%s AND exchange=%s",
+                (stock.symbol, stock.exchange),
+            )
+            stock_id = cur.fetchone()[0]
+
+        cur.execute(
+            self.RANKING_UPSERT.format(select=self.RANKING_SELECT + " WHERE s.id = %s")
+            + " RETURNING quality",
+            (stock_id,),
+        )
+        ranking_row = cur.fetchone()
+        if ranking_row and ranking_row[0] is not None:
+            # Quality is calculated by the database, keep the history in sync with it
+            try:
+                stock.stock_data.quality = StockQuality(ranking_row[0])
+            except ValueError:
+                pass
+
+        if stock.stock_data.news:
+            for news_item in stock.stock_data.news:
                 cur.execute(
-                    "SELECT id FROM stocks WHERE symbol=%s AND exchange=%s",
-                    (stock.symbol, stock.exchange),
+                    """INSERT INTO news(
+                    stock_id, news_id, title, summary, url, provider_name, provider_publish_time
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (news_id) DO NOTHING""",
+                    (
+                        stock_id,
+                        news_item.id,
+                        news_item.title,
+                        news_item.summary,
+                        news_item.url,
+                        news_item.provider_name,
+                        news_item.provider_publish_time,
+                    ),
                 )
-                stock_row = cur.fetchone()
 
-                if stock_row:
-                    stock_id = stock_row[0]
-                    cur.execute(
-                        """UPDATE stocks SET 
-                        current=%s, pe=%s, dcf=%s, roe=%s, exchange=%s, title=%s, industry=%s,
-                        marketcap=%s, revenue=%s, netincome=%s, assets=%s, liabilities=%s, debt=%s,
-                        esgscore=%s, controversy=%s, summary=%s, longtermdebt=%s,
-                        growthestimate=%s, currenteps=%s, historicalpe=%s, cashraweq=%s, fcfrawvalue=%s,
-                        sharesoutstandingraw=%s, stockholdersequityraw=%s, historicalroe=%s,
-                        trailingdividendrateraw=%s WHERE symbol=%s AND exchange=%s""",
-                        values + (stock.exchange,),
-                    )
-                    conn.commit()
-                else:
-                    cur.execute(
-                        """INSERT INTO stocks(
-                        current, pe, dcf, roe, exchange, title, industry, marketcap,
-                        revenue, netincome, assets, liabilities, debt, esgscore, controversy,
-                        summary, longtermdebt, growthestimate, currenteps,
-                        historicalpe, cashraweq, fcfrawvalue, sharesoutstandingraw,
-                        stockholdersequityraw, historicalroe, trailingdividendrateraw, symbol
-                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-                        values,
-                    )
-                    cur.execute(
-                        "SELECT id FROM stocks WHERE symbol=%s AND exchange=%s",
-                        (stock.symbol, stock.exchange),
-                    )
-                    conn.commit()
-                    stock_id = cur.fetchone()[0]
-
-                if stock.stock_data.news:
-                    for news_item in stock.stock_data.news:
-                        cur.execute(
-                            """INSERT INTO news(
-                            stock_id, news_id, title, summary, url, provider_name, provider_publish_time
-                            ) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (news_id) DO NOTHING""",
-                            (
-                                stock_id,
-                                news_item.id,
-                                news_item.title,
-                                news_item.summary,
-                                news_item.url,
-                                news_item.provider_name,
-                                news_item.provider_publish_time,
-                            ),
-                        )
-                    conn.commit()
-            return True
+    def update_stock_in_database(self, stock: Stock) -> bool:
+        """Update or insert stock in the database."""
+        try:
+            with self.connect_to_database() as conn:
+                cur = conn.cursor()
+                self.write_stock(cur, stock)
+                conn.commit()
         except psycopg2.Error as e:
             logging.error(f"Database update failed: {e}")
             return False
+
+        self.record_history(stock)
+        return True
+
+    def update_stocks_in_database(self, stocks: list[Stock]) -> list[Stock]:
+        """Update or insert a batch of stocks in one transaction.
+
+        If the batch fails, each stock is written on its own so that one bad
+        stock does not hold back the rest.
+
+        Args:
+            stocks (list[Stock]): The stocks to write.
+
+        Returns:
+            list[Stock]: The stocks the database rejected.
+
+        Raises:
+            psycopg2.OperationalError, psycopg2.InterfaceError: If the database is
+                unavailable, nothing is known to be written and the batch can be retried.
+        """
+        rejected = []
+        with self.connect_to_database() as conn:
+            cur = conn.cursor()
+            try:
+                for stock in stocks:
+                    self.write_stock(cur, stock)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.Error as e:
+                conn.rollback()
+                logging.warning(
+                    f"Batch update failed, writing {len(stocks)} stocks one at a time: {e}"
+                )
+                for stock in stocks:
+                    try:
+                        self.write_stock(cur, stock)
+                        conn.commit()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        raise
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        logging.error(f"Database update failed for {stock.symbol}: {e}")
+                        rejected.append(stock)
+
+        for stock in stocks:
+            if not any(stock is bad_stock for bad_stock in rejected):
+                self.record_history(stock)
+        return rejected
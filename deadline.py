@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Generator
+
+from log_handling import get_log_context
+from utils import DeadlineExceeded
+
+SYMBOL_DEADLINE = float(os.getenv("SYMBOL_DEADLINE", "120"))  # Seconds, 0 disables
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = 20  # Latencies needed for an endpoint before hedging it
+
+_active = threading.local()
+
+
+class Deadline:
+    """Time budget for everything fetched for one symbol."""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.start = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self) -> float:
+        return self.budget - self.elapsed()
+
+    def check(self) -> None:
+        """Raise DeadlineExceeded with the current stage once the budget is spent."""
+        if self.remaining() <= 0:
+            stage = get_log_context().get("stage", "unknown")
+            raise DeadlineExceeded(
+                stage,
+                f"Deadline of {self.budget:.0f}s exceeded after {self.elapsed():.1f}s in {stage}",
+            )
+
+
+@contextmanager
+def symbol_deadline(
+    budget: float = SYMBOL_DEADLINE,
+) -> Generator[Deadline | None, None, None]:
+    """Apply a deadline to the requests made in the block, a budget of 0 disables it."""
+    if budget <= 0:
+        yield None
+        return
+
+    previous = getattr(_active, "deadline", None)
+    _active.deadline = Deadline(budget)
+    try:
+        yield _active.deadline
+    finally:
+        _active.deadline = previous
+
+
+def current_deadline() -> Deadline | None:
+    return getattr(_active, "deadline", None)
+
+
+def check_deadline() -> None:
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+class LatencyTracker:
+    """Rolling request latencies per endpoint, used to decide when to hedge."""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self.lock = threading.Lock()
+        self.latencies: dict[str, deque] = {}
+
+    def record(self, endpoint: str, latency: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(
+                latency
+            )
+
+    def percentile(self, endpoint: str, fraction: float) -> float | None:
+        with self.lock:
+            latencies = sorted(self.latencies.get(endpoint, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
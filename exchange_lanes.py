@@ -0,0 +1,196 @@
+import logging
+import os
+import time
+
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from typing import Iterator, TypeVar
+
+from retry_queue import RETRY_COOLDOWN, RETRY_MAX_ATTEMPTS, RetryQueue
+
+logger = logging.getLogger(__name__)
+
+# Per exchange settings as "exchange:value" pairs, e.g. "nyse:2,cse:0.5"
+LANE_WEIGHTS = os.getenv("LANE_WEIGHTS", "")  # Share of fetch time, default 1
+LANE_BATCH_SIZES = os.getenv("LANE_BATCH_SIZES", "")  # Symbols per turn
+LANE_RETRY_ATTEMPTS = os.getenv("LANE_RETRY_ATTEMPTS", "")
+LANE_RETRY_COOLDOWNS = os.getenv("LANE_RETRY_COOLDOWNS", "")  # Seconds
+LANE_BATCH_SIZE = int(os.getenv("LANE_BATCH_SIZE", "10"))  # Default symbols per turn
+
+OUTCOMES = ("stored", "bad_stock", "deadline", "transient", "error")
+
+WorkItem = TypeVar("WorkItem", bound=tuple)
+
+
+def parse_exchange_setting(setting: str, value_type: type) -> dict:
+    """Parse "exchange:value" pairs, skipping entries that are not valid."""
+    values = {}
+    for pair in setting.split(","):
+        if not pair.strip():
+            continue
+        exchange, _, value = pair.partition(":")
+        try:
+            parsed = value_type(value)
+        except ValueError:
+            logger.warning(f"Ignoring invalid exchange setting '{pair}'")
+            continue
+        if parsed <= 0:
+            logger.warning(f"Ignoring exchange setting '{pair}', it must be positive")
+            continue
+        values[exchange.strip().lower()] = parsed
+    return values
+
+
+@dataclass
+class LaneStats:
+    symbols: int = 0
+    seconds: float = 0.0
+    outcomes: dict[str, int] = field(default_factory=dict)
+
+    def record(self, outcome: str, duration: float) -> None:
+        self.symbols += 1
+        self.seconds += duration
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+@dataclass
+class Lane:
+    exchange: str
+    weight: float
+    batch_size: int
+    retry_queue: RetryQueue
+    stats: LaneStats = field(default_factory=LaneStats)
+
+
+class ExchangeLanes:
+    """Per exchange work lanes, scheduled so each gets its share of fetch time.
+
+    TSX and CSE tickers fail and time out far more often than NAS and NYSE,
+    so sharing by symbol count would let a run of slow failures crowd out
+    the others. Each lane is charged the time its symbols take and the lane
+    with the least time per unit of weight goes next, for batch_size symbols.
+    Lanes retry their transient failures with their own policy.
+    """
+
+    def __init__(
+        self,
+        weights: dict[str, float] | None = None,
+        batch_sizes: dict[str, int] | None = None,
+        retry_attempts: dict[str, int] | None = None,
+        retry_cooldowns: dict[str, float] | None = None,
+    ):
+        self.weights = weights or {}
+        self.batch_sizes = batch_sizes or {}
+        self.retry_attempts = retry_attempts or {}
+        self.retry_cooldowns = retry_cooldowns or {}
+        self.lanes: dict[str, Lane] = {}
+
+    def lane(self, exchange: str) -> Lane:
+        """The lane of an exchange, created with its settings on first use."""
+        if exchange not in self.lanes:
+            self.lanes[exchange] = Lane(
+                exchange,
+                self.weights.get(exchange, 1.0),
+                self.batch_sizes.get(exchange, LANE_BATCH_SIZE),
+                RetryQueue(
+                    self.retry_attempts.get(exchange, RETRY_MAX_ATTEMPTS),
+                    self.retry_cooldowns.get(exchange, RETRY_COOLDOWN),
+                ),
+            )
+        return self.lanes[exchange]
+
+    def schedule(self, work: dict[str, Iterable[WorkItem]]) -> Iterator[WorkItem]:
+        """Interleave the symbols of each exchange by weighted fetch time.
+
+        Only the time spent after the schedule starts counts, so a lane that
+        was busy earlier in the run is not held back here. Time is charged
+        through record as the symbols are processed.
+        """
+        active = {exchange: iter(symbols) for exchange, symbols in work.items()}
+        start = {exchange: self.lane(exchange).stats.seconds for exchange in active}
+
+        def virtual_time(exchange: str) -> float:
+            lane = self.lane(exchange)
+            return (lane.stats.seconds - start[exchange]) / lane.weight
+
+        while active:
+            exchange = min(active, key=virtual_time)
+            for _ in range(self.lane(exchange).batch_size):
+                item = next(active[exchange], None)
+                if item is None:
+                    del active[exchange]
+                    break
+                yield item
+
+    def record(self, exchange: str, outcome: str, duration: float) -> None:
+        self.lane(exchange).stats.record(outcome, duration)
+
+    def retry(
+        self, symbol: str, exchange: str, error: Exception, module_profile: str
+    ) -> None:
+        self.lane(exchange).retry_queue.add(symbol, exchange, error, module_profile)
+
+    def pop_ready_retries(self) -> dict[str, list[tuple[str, str, str]]]:
+        """Remove and return the symbols whose cool-down has passed, by exchange."""
+        ready = {}
+        for exchange, lane in self.lanes.items():
+            symbols = lane.retry_queue.pop_ready()
+            if symbols:
+                ready[exchange] = symbols
+        return ready
+
+    def pending_retries(self) -> int:
+        return sum(len(lane.retry_queue) for lane in self.lanes.values())
+
+    def wait_for_next_retry(self) -> None:
+        """Sleep until the next retry of any lane is due."""
+        ready_times = [
+            ready_at
+            for lane in self.lanes.values()
+            if (ready_at := lane.retry_queue.next_ready_at()) is not None
+        ]
+        if ready_times:
+            time.sleep(max(0.0, min(ready_times) - time.time()))
+
+    def given_up(self) -> list[tuple[str, str]]:
+        return [
+            key for lane in self.lanes.values() for key in lane.retry_queue.given_up
+        ]
+
+    def log_summary(self) -> None:
+        """Log the throughput and failure rates of each lane."""
+        total_seconds = sum(lane.stats.seconds for lane in self.lanes.values())
+        for exchange, lane in sorted(self.lanes.items()):
+            stats = lane.stats
+            if not stats.symbols:
+                continue
+            rates = ", ".join(
+                f"{stats.outcomes.get(outcome, 0) / stats.symbols:.1%} {outcome}"
+                for outcome in OUTCOMES
+            )
+            per_minute = stats.symbols / stats.seconds * 60 if stats.seconds else 0.0
+            time_share = stats.seconds / total_seconds if total_seconds else 0.0
+            logger.info(
+                f"Lane {exchange}: {stats.symbols} symbols in {stats.seconds:.0f}s "
+                f"({per_minute:.1f}/min, {time_share:.0%} of fetch time), {rates}, "
+                f"{len(lane.retry_queue.given_up)} given up"
+            )
+
+
+def group_by_exchange(
+    symbols: Iterable[tuple[str, str]],
+) -> dict[str, list[tuple[str, str]]]:
+    groups: dict[str, list[tuple[str, str]]] = {}
+    for symbol, exchange in symbols:
+        groups.setdefault(exchange, []).append((symbol, exchange))
+    return groups
+
+
+def create_exchange_lanes() -> ExchangeLanes:
+    """Create the lanes with the settings from the environment."""
+    return ExchangeLanes(
+        parse_exchange_setting(LANE_WEIGHTS, float),
+        parse_exchange_setting(LANE_BATCH_SIZES, int),
+        parse_exchange_setting(LANE_RETRY_ATTEMPTS, int),
+        parse_exchange_setting(LANE_RETRY_COOLDOWNS, float),
+    )
@@ -0,0 +1,220 @@
+import gc
+import logging
+import multiprocessing
+import os
+import resource
+
+from logging.handlers import QueueHandler, QueueListener
+from deadline import SYMBOL_DEADLINE, symbol_deadline
+from log_handling import ContextFilter, log_context
+from profiler import SymbolProfiler, add_stage_times, stage_times
+from retry_queue import is_transient
+from stocks_handler import Stock, StockFactory
+from utils import BadStock, DeadlineExceeded, TransientError
+
+logger = logging.getLogger(__name__)
+
+# Fetches in a worker process that is replaced once it grows past the limit,
+# and pages through the work list instead of loading every symbol up front
+LONG_RUN_MODE = os.getenv("LONG_RUN_MODE", "false").lower() == "true"
+WORKER_MEMORY_LIMIT_MB = int(os.getenv("WORKER_MEMORY_LIMIT_MB", "512"))
+MEMORY_CHECK_INTERVAL = int(os.getenv("MEMORY_CHECK_INTERVAL", "500"))  # Symbols, 0 disables
+WORKER_REPLY_GRACE = 60  # Seconds past the symbol deadline before a worker counts as hung
+MB = 1024 * 1024
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """High-water mark of the resident set size of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def fetch_stock(symbol: str, exchange: str, module_profile: str = "full") -> Stock:
+    """Fetch a stock within the symbol deadline."""
+    with symbol_deadline():
+        return StockFactory.create_stock(symbol, exchange, module_profile)
+
+
+class ForwardHandler(logging.Handler):
+    """Hands records from the worker to the logger of the same name in this process."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def run_worker(connection, log_queue, profiler: SymbolProfiler) -> None:
+    """Fetch the requested stocks until told to stop, replying with each result.
+
+    Exceptions are sent back as plain values, BadStock and DeadlineExceeded do
+    not survive pickling with their attributes.
+    """
+    handler = QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    root_logger = logging.getLogger()
+    for existing_handler in list(root_logger.handlers):
+        root_logger.removeHandler(existing_handler)
+    root_logger.addHandler(handler)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            return
+
+        symbol, exchange, module_profile = request
+        with log_context(symbol=symbol, exchange=exchange), stage_times() as times:
+            with profiler.profile(symbol, exchange):
+                try:
+                    result = ("stock", fetch_stock(symbol, exchange, module_profile))
+                except BadStock as e:
+                    result = ("bad_stock", (e.stock_data, e.message))
+                except DeadlineExceeded as e:
+                    result = ("deadline", (e.stage, e.message))
+                except Exception as e:
+                    result = ("error", (str(e), is_transient(e)))
+        profile = profiler.profiles.pop() if profiler.profiles else None
+        connection.send(result + (profile, current_rss(), times))
+
+
+class FetchWorker:
+    """Fetches stocks in a child process that is recycled once it uses too much memory.
+
+    yahooquery, pandas and feedparser keep memory around that Python does not
+    hand back to the OS, so a long run grows even though nothing is kept per
+    symbol. Replacing the worker returns all of it. A worker that crashes or
+    stops responding is replaced as well and its symbol is retried later.
+    """
+
+    def __init__(
+        self, profiler: SymbolProfiler, memory_limit_mb: int = WORKER_MEMORY_LIMIT_MB
+    ):
+        self.profiler = profiler
+        self.memory_limit = memory_limit_mb * MB
+        self.reply_timeout = (
+            SYMBOL_DEADLINE + WORKER_REPLY_GRACE if SYMBOL_DEADLINE > 0 else None
+        )
+        # Fork so the worker does not re-run the fetcher's module level setup
+        self.context = multiprocessing.get_context("fork")
+        self.log_queue = self.context.Queue()
+        self.log_listener = QueueListener(self.log_queue, ForwardHandler())
+        self.process = None
+        self.connection = None
+        self.fetched = 0
+        self.recycles = 0
+        self.rss = 0
+        self.peak = 0  # Highest worker RSS since the last memory report
+
+    def start(self) -> None:
+        if self.process is None:
+            self.log_listener.start()
+        self.connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(
+            target=run_worker,
+            args=(child_connection, self.log_queue, self.profiler),
+            name="fetch-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.fetched = 0
+
+    def stop(self) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+    def restart(self, reason: str) -> None:
+        logger.info(f"Recycling fetch worker after {self.fetched} symbols: {reason}")
+        self.stop()
+        self.recycles += 1
+        self.start()
+
+    def fetch(self, symbol: str, exchange: str, module_profile: str = "full") -> Stock:
+        """Fetch a stock in the worker, raising the same exceptions as fetch_stock."""
+        if self.process is None:
+            self.start()
+
+        self.connection.send((symbol, exchange, module_profile))
+        try:
+            if not self.connection.poll(self.reply_timeout):
+                self.restart(f"no reply for {symbol}")
+                raise TransientError(f"Fetch worker did not reply for {symbol}")
+            status, payload, profile, rss, times = self.connection.recv()
+        except (EOFError, OSError):
+            exit_code = self.process.exitcode
+            self.restart(f"exited with code {exit_code} on {symbol}")
+            raise TransientError(f"Fetch worker exited while fetching {symbol}")
+
+        self.fetched += 1
+        self.rss = rss
+        self.peak = max(self.peak, rss)
+        if profile:
+            self.profiler.profiles.append(profile)
+        add_stage_times(times)
+        if self.memory_limit > 0 and rss > self.memory_limit:
+            self.restart(f"{rss / MB:.0f}MB is over the {self.memory_limit / MB:.0f}MB limit")
+
+        if status == "stock":
+            return payload
+        if status == "bad_stock":
+            raise BadStock(*payload)
+        if status == "deadline":
+            raise DeadlineExceeded(*payload)
+        message, transient = payload
+        if transient:
+            raise TransientError(message)
+        raise RuntimeError(message)
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        self.stop()
+        self.log_listener.stop()
+        self.process = None
+
+
+class MemoryWatermarks:
+    """Logs the memory high-water marks every `interval` symbols."""
+
+    def __init__(self, interval: int = MEMORY_CHECK_INTERVAL):
+        self.interval = interval
+        self.symbols = 0
+
+    def record(self, worker: FetchWorker | None = None) -> None:
+        """Count a processed symbol, logging the watermarks when the interval is up."""
+        self.symbols += 1
+        if self.interval <= 0 or self.symbols % self.interval:
+            return
+
+        gc.collect()
+        message = (
+            f"Memory after {self.symbols} symbols: rss {current_rss() / MB:.0f}MB, "
+            f"peak {peak_rss() / MB:.0f}MB"
+        )
+        if worker:
+            message += (
+                f", worker rss {worker.rss / MB:.0f}MB, worker peak "
+                f"{worker.peak / MB:.0f}MB, {worker.recycles} worker recycles"
+            )
+            worker.peak = worker.rss
+        logger.info(message)
+
+
+def create_fetch_worker(profiler: SymbolProfiler) -> FetchWorker | None:
+    """Create the fetch worker in long run mode, it is started on first use."""
+    if not LONG_RUN_MODE:
+        return None
+    return FetchWorker(profiler)
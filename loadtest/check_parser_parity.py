@@ -0,0 +1,138 @@
+"""Check that the fast Yahoo parser matches yahooquery's DataFrame path.
+
+Both parsers are run through a real yahooquery Ticker against the local
+Yahoo stand-in, so a yahooquery upgrade that changes the internals the fast
+parser relies on shows up here. The recorded payloads in loadtest/fixtures
+cover the edge cases: missing types and values, duplicate periods, two
+currencies, null entries, error results, live chart rows and empty chart
+rows. Synthetic symbols from the stand-in are checked as well.
+
+Run from the repository root:
+
+    python -m loadtest.check_parser_parity --symbols 30
+"""
+
+import argparse
+import logging
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from loadtest.yahoo_stub_server import StubConfig, start_stub_server
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture_symbols(fixtures_dir: str) -> list[str]:
+    """Symbols with a recorded payload for any endpoint."""
+    symbols = set()
+    for endpoint in os.listdir(fixtures_dir):
+        for file_name in os.listdir(os.path.join(fixtures_dir, endpoint)):
+            symbols.add(file_name.removesuffix(".json"))
+    return sorted(symbols)
+
+
+def compare_financials(ticker, types: list[str]) -> str | None:
+    """Compare the timeseries tables of both parsers, None when they match."""
+    from yahoo_parser import FinancialTable, fetch_financial_table
+
+    fast = fetch_financial_table(ticker, types)
+    try:
+        slow = ticker.get_financial_data(types, trailing=True)
+    except Exception as e:
+        # yahooquery fails on some malformed responses the fast parser reports as errors
+        slow = f"{type(e).__name__}: {e}"
+
+    if not isinstance(slow, pd.DataFrame):
+        if isinstance(fast, FinancialTable):
+            return f"pandas returned {slow!r}, fast parsed a table"
+        return None
+    if not isinstance(fast, FinancialTable):
+        return f"pandas parsed a table, fast returned {fast!r}"
+
+    slow = FinancialTable.from_dataframe(slow)
+    if fast.keys != slow.keys:
+        return f"periods differ: {fast.keys} != {slow.keys}"
+    if sorted(fast.columns) != sorted(slow.columns):
+        return f"types differ: {sorted(fast.columns)} != {sorted(slow.columns)}"
+    for data_type, values in fast.columns.items():
+        if not np.allclose(values, slow.columns[data_type], rtol=1e-12, equal_nan=True):
+            return f"{data_type} differs: {values} != {slow.columns[data_type]}"
+    return None
+
+
+def compare_closes(ticker, period: str, interval: str) -> str | None:
+    """Compare the close prices of both parsers, None when they match."""
+    from yahoo_parser import fetch_chart, history_closes
+
+    fast = history_closes(fetch_chart(ticker, period, interval))
+    history = ticker.history(period=period, interval=interval)
+    if isinstance(history, pd.DataFrame) and "close" in history:
+        slow = history["close"].to_numpy(dtype=np.float64)
+    else:
+        slow = np.array([], dtype=np.float64)
+
+    if len(fast) != len(slow) or not np.allclose(
+        fast, slow, rtol=1e-12, equal_nan=True
+    ):
+        return f"closes differ: {fast} != {slow}"
+    return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--symbols", type=int, default=30)
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    server = start_stub_server(
+        StubConfig(
+            latency_median=0.0,
+            latency_p99=0.0,
+            fixtures_dir=args.fixtures_dir,
+            seed=args.seed,
+        )
+    )
+
+    # The session reads its configuration at import time
+    os.environ["YAHOO_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    from stocks_handler import StockFactory
+    from yahoo_session import get_yahoo_session
+
+    yahoo_session = get_yahoo_session()
+    symbols = fixture_symbols(args.fixtures_dir) + [
+        f"SYM{i}" for i in range(args.symbols)
+    ]
+
+    mismatches = 0
+    for symbol in symbols:
+        ticker = yahoo_session.ticker(symbol)
+        for check, difference in (
+            ("timeseries", compare_financials(ticker, StockFactory.FINANCIAL_TYPES)),
+            ("chart", compare_closes(ticker, period="5y", interval="3mo")),
+        ):
+            if difference:
+                mismatches += 1
+                logger.error(f"{symbol} {check}: {difference}")
+    server.shutdown()
+
+    logger.info(
+        f"Checked {len(symbols)} symbols, {mismatches} parser mismatches found"
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # yahooquery's pandas calls raise FutureWarnings on newer pandas
+    warnings.simplefilter("ignore", FutureWarning)
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Drive analyze_and_update end to end against the local Yahoo stand-in.
+
+Run from the repository root with a local Postgres that has the Intrinsic
+schema loaded, configured through the usual DATABASE_* variables:
+
+    python -m loadtest.run_load_test --symbols 10000 --rate-limit-error-rate 0.01
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from loadtest.yahoo_stub_server import StubConfig, start_stub_server
+
+logger = logging.getLogger(__name__)
+
+EXCHANGES = ["nas", "nyse", "tsx", "cse"]
+
+
+def write_symbol_files(directory: str, symbol_count: int) -> list[str]:
+    """Write synthetic exchange files, spreading the symbols over the exchanges."""
+    symbols: dict[str, list[str]] = {exchange: [] for exchange in EXCHANGES}
+    for i in range(symbol_count):
+        symbols[EXCHANGES[i % len(EXCHANGES)]].append(f"LT{i:05d}")
+
+    for exchange, exchange_symbols in symbols.items():
+        with open(os.path.join(directory, f"{exchange}.txt"), "w") as file:
+            file.write("\n".join(exchange_symbols))
+    return [
+        exchange for exchange, exchange_symbols in symbols.items() if exchange_symbols
+    ]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--symbols", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-median", type=float, default=0.05)
+    parser.add_argument("--latency-p99", type=float, default=0.5)
+    parser.add_argument("--input-string-error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=30.0)
+    parser.add_argument("--throttle-rps", type=float, default=0.0)
+    parser.add_argument("--bad-symbol-rate", type=float, default=0.05)
+    parser.add_argument("--fixtures-dir", default=None)
+    parser.add_argument("--retry-cooldown", default="5")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = start_stub_server(
+        StubConfig(
+            latency_median=args.latency_median,
+            latency_p99=args.latency_p99,
+            input_string_error_rate=args.input_string_error_rate,
+            rate_limit_error_rate=args.rate_limit_error_rate,
+            timeout_rate=args.timeout_rate,
+            timeout_seconds=args.timeout_seconds,
+            throttle_rps=args.throttle_rps,
+            bad_symbol_rate=args.bad_symbol_rate,
+            fixtures_dir=args.fixtures_dir,
+            seed=args.seed,
+        ),
+        port=args.port,
+    )
+    symbol_dir = tempfile.mkdtemp(prefix="stock-fetcher-loadtest-")
+    exchanges = write_symbol_files(symbol_dir, args.symbols)
+
+    # The fetcher reads its configuration at import time
+    os.environ["YAHOO_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["EXCHANGE_FILES_DIRECTORY"] = symbol_dir
+    os.environ.setdefault("RETRY_COOLDOWN", args.retry_cooldown)
+    import stock_fetcher
+
+    latencies: list[float] = []
+    update_stock = stock_fetcher.update_stock
+
+    def timed_update_stock(*args):
+        start = time.perf_counter()
+        try:
+            return update_stock(*args)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    stock_fetcher.update_stock = timed_update_stock
+
+    start = time.perf_counter()
+    stock_fetcher.analyze_and_update(0, exchanges)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    stats = server.stats
+    report = [
+        f"Symbols: {args.symbols}, symbol fetches: {len(latencies)}",
+        f"Elapsed: {elapsed:.1f}s, throughput: {len(latencies) / elapsed:.2f} symbols/s",
+        "Per-symbol latency: "
+        + ", ".join(
+            f"p{int(fraction * 100)}={percentile(latencies, fraction):.2f}s"
+            for fraction in (0.5, 0.95, 0.99)
+        )
+        + f", max={max(latencies, default=0):.2f}s",
+        f"Requests by endpoint: {dict(stats.requests)}",
+        f"Responses by status: {dict(stats.statuses)}",
+        f"Injected errors: {dict(stats.injected)}",
+        f"Symbols given up after retries: {len(stock_fetcher.lanes.given_up())}",
+    ]
+    for exchange, lane in sorted(stock_fetcher.lanes.lanes.items()):
+        report.append(
+            f"Lane {exchange}: {lane.stats.symbols} symbols in {lane.stats.seconds:.1f}s, "
+            f"outcomes: {lane.stats.outcomes}"
+        )
+    logger.info("Load test report:\n" + "\n".join(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from collections import Counter
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+QUARTER_SECONDS = 91 * 24 * 60 * 60
+YEAR_SECONDS = 365 * 24 * 60 * 60
+
+
+@dataclass
+class StubConfig:
+    latency_median: float = 0.05  # Seconds
+    latency_p99: float = 0.5  # Seconds, latency is log-normal between the two
+    input_string_error_rate: float = 0.0  # quoteSummary "For input string" errors
+    rate_limit_error_rate: float = 0.0  # Random 429 responses
+    timeout_rate: float = 0.0  # Requests that hang for timeout_seconds
+    timeout_seconds: float = 30.0
+    throttle_rps: float = 0.0  # Requests per second before answering 429, 0 disables
+    bad_symbol_rate: float = 0.0  # Symbols without a price, stored as BadStock
+    fixtures_dir: str | None = None  # Recorded responses, <endpoint>/<symbol>.json
+    seed: int = 0
+
+
+@dataclass
+class StubStats:
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    requests: Counter = field(default_factory=Counter)
+    statuses: Counter = field(default_factory=Counter)
+    injected: Counter = field(default_factory=Counter)
+
+    def record(self, endpoint: str, status: int) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+
+    def inject(self, error: str) -> None:
+        with self.lock:
+            self.injected[error] += 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def raw(value: float) -> dict:
+    return {"raw": value, "fmt": f"{value:.2f}"}
+
+
+class SyntheticData:
+    """Deterministic synthetic Yahoo payloads, the same symbol always gets the same data."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+
+    def rng(self, symbol: str, salt: str = "") -> random.Random:
+        return random.Random(f"{self.config.seed}-{symbol}-{salt}")
+
+    def fundamentals(self, symbol: str) -> dict:
+        rng = self.rng(symbol)
+        shares = rng.uniform(1e7, 5e9)
+        eps = rng.uniform(-1, 10)
+        equity = shares * rng.uniform(2, 60)
+        return {
+            "price": rng.uniform(1, 500),
+            "shares": shares,
+            "eps": eps,
+            "growth": rng.uniform(-0.1, 0.4),
+            "dividend": rng.choice([0.0, rng.uniform(0.1, 5)]),
+            "revenue": shares * rng.uniform(1, 100),
+            "net_income": shares * eps,
+            "assets": equity * rng.uniform(1.2, 4),
+            "liabilities": equity * rng.uniform(0.2, 3),
+            "debt": equity * rng.uniform(0, 1.5),
+            "cash": equity * rng.uniform(0.05, 0.5),
+            "equity": equity,
+            "fcf": shares * rng.uniform(-2, 12),
+        }
+
+    def quote_summary(self, symbol: str, modules: list[str]) -> dict:
+        data = self.fundamentals(symbol)
+        rng = self.rng(symbol, "bad")
+        price = (
+            {}
+            if rng.random() < self.config.bad_symbol_rate
+            else {"regularMarketPrice": raw(data["price"])}
+        )
+        quarterly_cashflow = [
+            {
+                "totalCashFromOperatingActivities": raw(data["fcf"] / 4 * 1.3),
+                "capitalExpenditures": raw(-data["fcf"] / 4 * 0.3),
+            }
+            for _ in range(4)
+        ]
+        balance_sheet = [
+            {
+                "totalAssets": raw(data["assets"]),
+                "totalLiab": raw(data["liabilities"]),
+                "longTermDebt": raw(data["debt"] * 0.8),
+                "cash": raw(data["cash"]),
+                "totalStockholderEquity": raw(data["equity"]),
+            }
+        ]
+        payload = {
+            "price": price,
+            "quoteType": {"longName": f"{symbol} Synthetic Corp"},
+            "assetProfile": {"industry": "Synthetic Industry"},
+            "esgScores": {"totalEsg": raw(rng.uniform(5, 40)), "highestControversy": 2},
+            "summaryProfile": {
+                "longBusinessSummary": f"{symbol} makes synthetic data."
+            },
+            "earningsTrend": {"trend": [{}, {}, {}, {"growth": raw(data["growth"])}]},
+            "defaultKeyStatistics": {
+                "trailingEps": raw(data["eps"]),
+                "sharesOutstanding": raw(data["shares"]),
+            },
+            "summaryDetail": {
+                "marketCap": raw(data["price"] * data["shares"]),
+                "trailingAnnualDividendRate": raw(data["dividend"]),
+            },
+            "financialData": {
+                "totalDebt": raw(data["debt"]),
+                "returnOnEquity": raw(data["net_income"] / data["equity"]),
+            },
+            "incomeStatementHistory": {
+                "incomeStatementHistory": [
+                    {
+                        "totalRevenue": raw(data["revenue"]),
+                        "netIncome": raw(data["net_income"]),
+                    }
+                ]
+            },
+            "balanceSheetHistory": {"balanceSheetStatements": balance_sheet},
+            "balanceSheetHistoryQuarterly": {"balanceSheetStatements": balance_sheet},
+            "cashflowStatementHistoryQuarterly": {
+                "cashflowStatements": quarterly_cashflow
+            },
+        }
+        return {module: payload[module] for module in modules if module in payload}
+
+    def timeseries(self, symbol: str, types: list[str]) -> list[dict]:
+        data = self.fundamentals(symbol)
+        values = {
+            "BasicEPS": data["eps"],
+            "MarketCap": data["price"] * data["shares"],
+            "TotalRevenue": data["revenue"],
+            "NetIncome": data["net_income"],
+            "TotalAssets": data["assets"],
+            "TotalLiabilitiesNetMinorityInterest": data["liabilities"],
+            "TotalDebt": data["debt"],
+            "LongTermDebt": data["debt"] * 0.8,
+            "CashAndCashEquivalents": data["cash"],
+            "FreeCashFlow": data["fcf"],
+            "StockholdersEquity": data["equity"],
+        }
+        now = int(time.time())
+        results = []
+        for data_type in types:
+            trailing = data_type.startswith("trailing")
+            base_type = data_type.removeprefix("trailing").removeprefix("annual")
+            if base_type not in values:
+                results.append({"meta": {"symbol": [symbol], "type": [data_type]}})
+                continue
+
+            rng = self.rng(symbol, data_type)
+            years = 1 if trailing else 4
+            timestamps = [now - YEAR_SECONDS * (years - i) for i in range(years)]
+            results.append(
+                {
+                    "meta": {"symbol": [symbol], "type": [data_type]},
+                    "timestamp": timestamps,
+                    data_type: [
+                        {
+                            "dataId": i,
+                            "asOfDate": time.strftime("%Y-%m-%d", time.gmtime(stamp)),
+                            "periodType": "TTM" if trailing else "12M",
+                            "currencyCode": "USD",
+                            "reportedValue": raw(
+                                values[base_type] * rng.uniform(0.7, 1.1)
+                            ),
+                        }
+                        for i, stamp in enumerate(timestamps)
+                    ],
+                }
+            )
+        return results
+
+    def chart(self, symbol: str) -> dict:
+        data = self.fundamentals(symbol)
+        rng = self.rng(symbol, "chart")
+        end = int(time.time()) - 30 * 24 * 60 * 60
+        timestamps = [end - QUARTER_SECONDS * (19 - i) for i in range(20)]
+        closes = [data["price"] * rng.uniform(0.6, 1.2) for _ in timestamps]
+        return {
+            "meta": {
+                "symbol": symbol,
+                "exchangeTimezoneName": "America/New_York",
+                "exchangeName": "NMS",
+                "regularMarketTime": end + 24 * 60 * 60,
+            },
+            "timestamp": timestamps,
+            "indicators": {
+                "quote": [
+                    {
+                        "open": closes,
+                        "high": [close * 1.05 for close in closes],
+                        "low": [close * 0.95 for close in closes],
+                        "close": closes,
+                        "volume": [rng.randint(1000, 10**7) for _ in timestamps],
+                    }
+                ],
+                "adjclose": [{"adjclose": closes}],
+            },
+        }
+
+    def rss(self, symbol: str) -> str:
+        items = "".join(
+            f"""<item><title>{symbol} headline {i}</title>
+            <link>https://example.com/{symbol}/{i}</link>
+            <description>Synthetic news {i} for {symbol}</description>
+            <guid>{symbol}-{i}-{int(time.time() // 86400)}</guid>
+            <pubDate>{formatdate(time.time() - i * 3600)}</pubDate></item>"""
+            for i in range(5)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f"<title>{symbol} news</title>{items}</channel></rss>"
+        )
+
+
+class YahooStubServer(ThreadingHTTPServer):
+    """Local stand-in for the Yahoo endpoints used by the fetcher."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], config: StubConfig):
+        super().__init__(address, YahooStubHandler)
+        self.config = config
+        self.data = SyntheticData(config)
+        self.stats = StubStats()
+        self.bucket = TokenBucket(config.throttle_rps) if config.throttle_rps else None
+        self.latency_sigma = (
+            math.log(config.latency_p99 / config.latency_median) / 2.326
+            if config.latency_p99 > config.latency_median > 0
+            else 0.0
+        )
+
+    def latency(self) -> float:
+        if self.config.latency_median <= 0:
+            return 0.0
+        return self.config.latency_median * math.exp(
+            self.latency_sigma * random.gauss(0, 1)
+        )
+
+    def fixture(self, endpoint: str, symbol: str) -> dict | None:
+        if not self.config.fixtures_dir:
+            return None
+        path = os.path.join(self.config.fixtures_dir, endpoint, f"{symbol}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as file:
+            return json.load(file)
+
+
+class YahooStubHandler(BaseHTTPRequestHandler):
+    server: YahooStubServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_body(self, endpoint: str, status: int, body: str, content_type: str):
+        encoded = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+        self.server.stats.record(endpoint, status)
+
+    def send_json(self, endpoint: str, payload: dict, status: int = 200):
+        self.send_body(endpoint, status, json.dumps(payload), "application/json")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        symbol = unquote(parts[-1]) if parts else ""
+        config = self.server.config
+
+        if url.path.startswith("/v10/finance/quoteSummary/"):
+            endpoint = "quoteSummary"
+        elif url.path.startswith("/v8/finance/chart/"):
+            endpoint = "chart"
+        elif "/timeseries/" in url.path:
+            endpoint = "timeseries"
+        elif url.path.startswith("/rss/"):
+            endpoint = "rss"
+            symbol = query.get("s", [""])[0]
+        elif url.path == "/v1/test/getcrumb":
+            self.send_body("crumb", 200, "stubcrumb", "text/plain")
+            return
+        else:
+            self.send_body("setup", 200, "<html></html>", "text/html")
+            return
+
+        if self.server.bucket and not self.server.bucket.take():
+            self.server.stats.inject("throttled")
+            self.send_json(
+                endpoint,
+                {"finance": {"error": {"description": "Too Many Requests"}}},
+                429,
+            )
+            return
+
+        time.sleep(self.server.latency())
+        if random.random() < config.timeout_rate:
+            self.server.stats.inject("timeout")
+            time.sleep(config.timeout_seconds)
+        if random.random() < config.rate_limit_error_rate:
+            self.server.stats.inject("429")
+            self.send_json(
+                endpoint,
+                {"finance": {"error": {"description": "Too Many Requests"}}},
+                429,
+            )
+            return
+
+        if endpoint == "rss":
+            self.send_body(
+                endpoint, 200, self.server.data.rss(symbol), "application/rss+xml"
+            )
+            return
+
+        payload = self.server.fixture(endpoint, symbol)
+        if payload is not None:
+            self.send_json(endpoint, payload)
+        elif endpoint == "quoteSummary":
+            if random.random() < config.input_string_error_rate:
+                self.server.stats.inject("for input string")
+                self.send_json(
+                    endpoint,
+                    {
+                        "quoteSummary": {
+                            "result": None,
+                            "error": {
+                                "code": "Internal Server Error",
+                                "description": 'java.lang.NumberFormatException: For input string: "NaN"',
+                            },
+                        }
+                    },
+                )
+                return
+            modules = ",".join(query.get("modules", [])).split(",")
+            self.send_json(
+                endpoint,
+                {
+                    "quoteSummary": {
+                        "result": [self.server.data.quote_summary(symbol, modules)],
+                        "error": None,
+                    }
+                },
+            )
+        elif endpoint == "chart":
+            self.send_json(
+                endpoint,
+                {"chart": {"result": [self.server.data.chart(symbol)], "error": None}},
+            )
+        else:
+            types = ",".join(query.get("type", [])).split(",")
+            self.send_json(
+                endpoint,
+                {
+                    "timeseries": {
+                        "result": self.server.data.timeseries(symbol, types),
+                        "error": None,
+                    }
+                },
+            )
+
+
+def start_stub_server(
+    config: StubConfig, host: str = "127.0.0.1", port: int = 0
+) -> YahooStubServer:
+    """Start the stand-in server on a background thread, port 0 picks a free port."""
+    server = YahooStubServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Yahoo stand-in listening on {host}:{server.server_address[1]}")
+    return server
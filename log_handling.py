@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Generator
+
+CONTEXT_FIELDS = ("symbol", "exchange", "stage", "duration", "stages")
+
+_context = threading.local()
+
+
+@contextmanager
+def log_context(**fields) -> Generator[None, None, None]:
+    """Add fields such as symbol and stage to every record logged in the block."""
+    previous = getattr(_context, "fields", {})
+    _context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+def get_log_context() -> dict:
+    """Return the log_context fields set in the current thread."""
+    return dict(getattr(_context, "fields", {}))
+
+
+class ContextFilter(logging.Filter):
+    """Copies the current log_context fields onto each record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in getattr(_context, "fields", {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class RepeatFilter(logging.Filter):
+    """Rate limits identical warning and error messages.
+
+    Only the first `limit` copies of a message are kept per `window` seconds,
+    the first copy after the window notes how many were suppressed. yahooquery
+    and pandas can repeat the same error for thousands of symbols.
+    """
+
+    MAX_TRACKED = 10000
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen: dict[str, tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        # The same record can pass through several handlers
+        if hasattr(record, "repeat_allowed"):
+            return record.repeat_allowed
+
+        message = record.getMessage()
+        now = time.monotonic()
+        with self.lock:
+            if len(self.seen) > self.MAX_TRACKED:
+                self.seen.clear()
+            window_start, count = self.seen.get(message, (now, 0))
+            if now - window_start > self.window:
+                suppressed = count - self.limit
+                if suppressed > 0:
+                    record.msg = f"{message} ({suppressed} repeats suppressed)"
+                    record.args = None
+                window_start, count = now, 0
+            self.seen[message] = (window_start, count + 1)
+
+        record.repeat_allowed = count < self.limit
+        return record.repeat_allowed
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including the context fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -0,0 +1,183 @@
+import logging
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import date, datetime
+from stocks_handler import Stock
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("EXPORT_DIR")  # Unset disables the export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# (StockData attribute, column name)
+NUMBER_FIELDS = [
+    ("current_price", "current"),
+    ("pe", "pe"),
+    ("dcf", "dcf"),
+    ("roe", "roe"),
+    ("market_cap", "market_cap"),
+    ("revenue", "revenue"),
+    ("net_income", "net_income"),
+    ("assets", "assets"),
+    ("liabilities", "liabilities"),
+    ("debt", "debt"),
+    ("esg_score", "esg_score"),
+    ("controversy", "controversy"),
+    ("long_term_debt", "long_term_debt"),
+    ("growth_estimate", "growth_estimate"),
+    ("current_eps", "current_eps"),
+    ("historical_pe", "historical_pe"),
+    ("cash_raw_eq", "cash"),
+    ("fcf_raw_value", "fcf"),
+    ("shares_outstanding_raw", "shares_outstanding"),
+    ("stockholders_equity_raw", "stockholders_equity"),
+    ("historical_roe", "historical_roe"),
+    ("trailing_dividend_rate_raw", "trailing_dividend_rate"),
+]
+STRING_FIELDS = [("title", "title"), ("industry", "industry"), ("summary", "summary")]
+
+STOCK_SCHEMA = pa.schema(
+    [
+        ("symbol", pa.string()),
+        ("exchange", pa.string()),
+        ("recorded_at", pa.timestamp("s")),
+        ("quality", pa.int8()),
+    ]
+    + [(column, pa.float64()) for _, column in NUMBER_FIELDS]
+    + [(column, pa.string()) for _, column in STRING_FIELDS]
+)
+NEWS_SCHEMA = pa.schema(
+    [
+        ("symbol", pa.string()),
+        ("exchange", pa.string()),
+        ("news_id", pa.string()),
+        ("title", pa.string()),
+        ("summary", pa.string()),
+        ("url", pa.string()),
+        ("provider_name", pa.string()),
+        ("provider_publish_time", pa.timestamp("s")),
+    ]
+)
+
+
+def unwrap(value):
+    """Some StockData fields are stored as one element tuples, return the value itself."""
+    if isinstance(value, tuple):
+        return value[0] if value else None
+    return value
+
+
+def number(value) -> float | None:
+    value = unwrap(value)
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def string(value) -> str | None:
+    value = unwrap(value)
+    return str(value) if value is not None else None
+
+
+class PartitionWriter:
+    """Streams rows of one partition into a Parquet file, one row group per batch."""
+
+    def __init__(self, directory: str, schema: pa.Schema, batch_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"part-{datetime.now():%H%M%S}.parquet")
+        self.schema = schema
+        self.batch_size = batch_size
+        self.rows: list[dict] = []
+        self.writer = pq.ParquetWriter(self.path + ".tmp", schema)
+
+    def add(self, row: dict) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self) -> None:
+        """Write the remaining rows and move the finished file into place."""
+        self.flush()
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class RunExporter:
+    """Exports each stored stock and its news as Parquet, partitioned by run date and exchange.
+
+    Files are laid out as <export_dir>/<table>/run_date=<date>/exchange=<exchange>/,
+    which pyarrow.dataset and most query engines read as hive partitions.
+    """
+
+    def __init__(self, export_dir: str, batch_size: int = EXPORT_BATCH_SIZE):
+        self.export_dir = export_dir
+        self.batch_size = batch_size
+        self.run_date = date.today()
+        self.writers: dict[tuple[str, str], PartitionWriter] = {}
+
+    def writer(self, table: str, exchange: str, schema: pa.Schema) -> PartitionWriter:
+        key = (table, exchange)
+        if key not in self.writers:
+            directory = os.path.join(
+                self.export_dir,
+                table,
+                f"run_date={self.run_date.isoformat()}",
+                f"exchange={exchange}",
+            )
+            self.writers[key] = PartitionWriter(directory, schema, self.batch_size)
+        return self.writers[key]
+
+    def add(self, stock: Stock) -> None:
+        """Add a stored stock and its news to the export."""
+        stock_data = stock.stock_data
+        row = {
+            "symbol": stock.symbol,
+            "exchange": stock.exchange,
+            "recorded_at": datetime.now(),
+            "quality": stock_data.quality.value,
+        }
+        row.update(
+            {column: number(getattr(stock_data, name)) for name, column in NUMBER_FIELDS}
+        )
+        row.update(
+            {column: string(getattr(stock_data, name)) for name, column in STRING_FIELDS}
+        )
+        self.writer("stocks", stock.exchange, STOCK_SCHEMA).add(row)
+
+        if not stock_data.news:
+            return
+        news_writer = self.writer("news", stock.exchange, NEWS_SCHEMA)
+        for news_item in stock_data.news:
+            news_writer.add(
+                {
+                    "symbol": stock.symbol,
+                    "exchange": stock.exchange,
+                    "news_id": news_item.id,
+                    "title": news_item.title,
+                    "summary": news_item.summary,
+                    "url": news_item.url,
+                    "provider_name": news_item.provider_name,
+                    "provider_publish_time": news_item.provider_publish_time,
+                }
+            )
+
+    def close(self) -> None:
+        for (table, exchange), writer in self.writers.items():
+            try:
+                writer.close()
+                logger.info(f"Exported {table} for {exchange} to {writer.path}")
+            except (OSError, pa.ArrowException) as e:
+                logger.error(f"Error closing {table} export for {exchange}: {e}")
+        self.writers = {}
+
+
+def create_run_exporter() -> RunExporter | None:
+    """Create the exporter if EXPORT_DIR is set."""
+    if not EXPORT_DIR:
+        return None
+    return RunExporter(EXPORT_DIR)
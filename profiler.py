@@ -0,0 +1,178 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from deadline import check_deadline
+from log_handling import log_context
+from typing import Generator
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 0 disables profiling
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+PROFILE_TOP_FUNCTIONS = 10  # Functions listed per symbol in the report
+
+_active = threading.local()
+
+
+@dataclass
+class SymbolProfile:
+    symbol: str
+    exchange: str
+    total_time: float = 0.0
+    peak_memory: int = 0
+    stages: dict[str, float] = field(default_factory=dict)
+    top_functions: str = ""
+
+    def add_stage_time(self, stage_name: str, elapsed: float) -> None:
+        self.stages[stage_name] = self.stages.get(stage_name, 0.0) + elapsed
+
+    def describe(self) -> str:
+        stages = ", ".join(
+            f"{name}={elapsed:.2f}s"
+            for name, elapsed in sorted(
+                self.stages.items(), key=lambda item: item[1], reverse=True
+            )
+        )
+        return (
+            f"{self.symbol} - {self.exchange}: {self.total_time:.2f}s, "
+            f"peak {self.peak_memory / 1024 / 1024:.1f}MB [{stages}]"
+        )
+
+
+@contextmanager
+def stage(stage_name: str, network: bool = False) -> Generator[None, None, None]:
+    """Attribute the time spent in the block to a stage of the profiled symbol.
+
+    Records logged in the block are tagged with the stage, and the stage time
+    is logged at debug level with the duration field. Network stages raise
+    DeadlineExceeded if the symbol deadline has already passed, local stages
+    always run so a fully fetched stock is not thrown away.
+    """
+    with log_context(stage=stage_name):
+        if network:
+            check_deadline()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            add_stage_times({stage_name: elapsed})
+            profile: SymbolProfile | None = getattr(_active, "profile", None)
+            if profile is not None:
+                profile.add_stage_time(stage_name, elapsed)
+            logger.debug(
+                f"Stage {stage_name} took {elapsed:.3f}s",
+                extra={"duration": round(elapsed, 3)},
+            )
+
+
+@contextmanager
+def stage_times() -> Generator[dict[str, float], None, None]:
+    """Collect the time spent in each stage run in the block, profiled or not."""
+    previous = getattr(_active, "stage_times", None)
+    _active.stage_times = {}
+    try:
+        yield _active.stage_times
+    finally:
+        _active.stage_times = previous
+
+
+def add_stage_times(times: dict[str, float]) -> None:
+    """Add stage times, e.g. from the fetch worker, to the stage_times block."""
+    collected: dict[str, float] | None = getattr(_active, "stage_times", None)
+    if collected is None:
+        return
+    for stage_name, elapsed in times.items():
+        collected[stage_name] = collected.get(stage_name, 0.0) + elapsed
+
+
+class SymbolProfiler:
+    """Profiles a random sample of symbols with cProfile and tracemalloc."""
+
+    def __init__(
+        self, sample_rate: float = PROFILE_SAMPLE_RATE, top_n: int = PROFILE_TOP_N
+    ):
+        self.sample_rate = sample_rate
+        self.top_n = top_n
+        self.profiles: list[SymbolProfile] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    @contextmanager
+    def profile(self, symbol: str, exchange: str) -> Generator[None, None, None]:
+        """Profile the block for a symbol if it is picked by the sample rate."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield
+            return
+
+        profile = SymbolProfile(symbol, exchange)
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        _active.profile = profile
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profile.total_time = time.perf_counter() - start
+            _active.profile = None
+            profile.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            stats_output = io.StringIO()
+            pstats.Stats(profiler, stream=stats_output).sort_stats(
+                "cumulative"
+            ).print_stats(PROFILE_TOP_FUNCTIONS)
+            profile.top_functions = stats_output.getvalue()
+            self.profiles.append(profile)
+
+    def build_report(self) -> str:
+        """Build the slowest and most memory hungry symbol report."""
+        slowest = sorted(self.profiles, key=lambda p: p.total_time, reverse=True)
+        hungriest = sorted(self.profiles, key=lambda p: p.peak_memory, reverse=True)
+
+        stage_totals: dict[str, float] = {}
+        for profile in self.profiles:
+            for stage_name, elapsed in profile.stages.items():
+                stage_totals[stage_name] = stage_totals.get(stage_name, 0.0) + elapsed
+
+        lines = [f"Profiled {len(self.profiles)} symbols", "", "Time per stage:"]
+        lines += [
+            f"  {name}: {elapsed:.2f}s"
+            for name, elapsed in sorted(
+                stage_totals.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        lines += ["", f"Top {self.top_n} slowest symbols:"]
+        lines += [f"  {profile.describe()}" for profile in slowest[: self.top_n]]
+        lines += ["", f"Top {self.top_n} symbols by peak memory:"]
+        lines += [f"  {profile.describe()}" for profile in hungriest[: self.top_n]]
+        lines += ["", "Slowest symbol call profiles:"]
+        for profile in slowest[: self.top_n]:
+            lines += ["", f"{profile.symbol} - {profile.exchange}", profile.top_functions]
+        return "\n".join(lines)
+
+    def write_report(self, report_dir: str) -> None:
+        """Write the report to the report directory if anything was profiled."""
+        if not self.profiles:
+            return
+
+        report_path = os.path.join(report_dir, "profile-report.txt")
+        try:
+            with open(report_path, "w") as file:
+                file.write(self.build_report())
+            logger.info(f"Profile report written to {report_path}")
+        except IOError as e:
+            logger.error(f"Error writing profile report {report_path}: {e}")
@@ -0,0 +1,101 @@
+import heapq
+import logging
+import os
+import time
+import requests
+
+from dataclasses import dataclass, field
+from utils import TransientError, is_transient_message
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_COOLDOWN = float(os.getenv("RETRY_COOLDOWN", "300"))  # Seconds, doubled per attempt
+
+
+def is_transient(error: Exception) -> bool:
+    """Classify an error raised while fetching a stock as transient or permanent."""
+    if isinstance(error, TransientError):
+        return True
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return is_transient_message(str(error))
+
+
+@dataclass(order=True)
+class RetryEntry:
+    ready_at: float
+    symbol: str = field(compare=False)
+    exchange: str = field(compare=False)
+    attempts: int = field(compare=False)
+    module_profile: str = field(compare=False, default="full")
+
+
+class RetryQueue:
+    """Deferred retries for symbols that failed with transient errors.
+
+    Failed symbols wait out a cool-down that doubles with every attempt, so the
+    main loop never blocks on a single symbol. Symbols are dropped after
+    max_attempts failures.
+    """
+
+    def __init__(
+        self, max_attempts: int = RETRY_MAX_ATTEMPTS, cooldown: float = RETRY_COOLDOWN
+    ):
+        self.max_attempts = max_attempts
+        self.cooldown = cooldown
+        self.entries: list[RetryEntry] = []
+        self.attempts: dict[tuple[str, str], int] = {}
+        self.given_up: list[tuple[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(
+        self,
+        symbol: str,
+        exchange: str,
+        error: Exception,
+        module_profile: str = "full",
+    ) -> None:
+        """Schedule a retry for the symbol unless it has run out of attempts.
+
+        The retry fetches the same modules, given by module_profile.
+        """
+        key = (symbol, exchange)
+        attempts = self.attempts.get(key, 0) + 1
+        self.attempts[key] = attempts
+
+        if attempts >= self.max_attempts:
+            logger.error(
+                f"Giving up on {symbol} - {exchange} after {attempts} attempts: {error}"
+            )
+            self.given_up.append(key)
+            return
+
+        delay = self.cooldown * (2 ** (attempts - 1))
+        logger.warning(
+            f"Transient error for {symbol} - {exchange}, retrying in {delay:.0f}s: {error}"
+        )
+        heapq.heappush(
+            self.entries,
+            RetryEntry(time.time() + delay, symbol, exchange, attempts, module_profile),
+        )
+
+    def pop_ready(self) -> list[tuple[str, str, str]]:
+        """Remove and return the symbols whose cool-down has passed.
+
+        Each is returned as (symbol, exchange, module_profile).
+        """
+        ready = []
+        now = time.time()
+        while self.entries and self.entries[0].ready_at <= now:
+            entry = heapq.heappop(self.entries)
+            ready.append((entry.symbol, entry.exchange, entry.module_profile))
+        return ready
+
+    def next_ready_at(self) -> float | None:
+        """Time the next retry is due, None when the queue is empty."""
+        return self.entries[0].ready_at if self.entries else None
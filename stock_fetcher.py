@@ -1,12 +1,29 @@
+import atexit
 import logging
+import queue
 import random
 import warnings
 import time
 import os
-from logging.handlers import RotatingFileHandler
+from collections.abc import Iterable, Sized
+from contextlib import nullcontext
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from database_handler import DatabaseHandler
-from stocks_handler import StockFactory
-from utils import BadStock
+from exchange_lanes import create_exchange_lanes, group_by_exchange
+from fetch_worker import (
+    LONG_RUN_MODE,
+    MemoryWatermarks,
+    create_fetch_worker,
+    fetch_stock,
+)
+from log_handling import ContextFilter, JsonFormatter, RepeatFilter, log_context
+from parquet_exporter import create_run_exporter
+from profiler import SymbolProfiler, stage, stage_times
+from retry_queue import is_transient
+from stocks_handler import Stock, StockFactory
+from utils import BadStock, DeadlineExceeded
+from valuation_grid import run_valuation_grid
+from write_spool import create_write_spool
 
 # Log directory setup
 log_dir = os.getenv("LOG_DIR", "/var/log/stock-fetcher/")
@@ -30,21 +47,48 @@ log_handler = RotatingFileHandler(
 # Log level from environment
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 
+# Async writes records from a background thread, json adds symbol/stage/duration fields
+log_async = os.getenv("LOG_ASYNC", "true").lower() == "true"
+log_format = os.getenv("LOG_FORMAT", "text").lower()
+log_repeat_limit = int(os.getenv("LOG_REPEAT_LIMIT", "5"))  # 0 disables rate limiting
+log_repeat_window = float(os.getenv("LOG_REPEAT_WINDOW", "60"))
+
 # Formatter
-formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+if log_format == "json":
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
 log_handler.setFormatter(formatter)
 
 # Stream handler
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 
-# Root logger configuration
+if log_async:
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, log_handler, stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    root_handlers = [QueueHandler(log_queue)]
+else:
+    root_handlers = [log_handler, stream_handler]
+
+repeat_filter = RepeatFilter(log_repeat_limit, log_repeat_window)
+for handler in root_handlers:
+    handler.addFilter(ContextFilter())
+    if log_repeat_limit > 0:
+        handler.addFilter(repeat_filter)
+
+# Root logger configuration, replacing the basicConfig handler from utils which
+# would print every record a second time
 root_logger = logging.getLogger()
 root_logger.setLevel(getattr(logging, log_level, logging.INFO))
-root_logger.addHandler(log_handler)
-root_logger.addHandler(stream_handler)
+for handler in list(root_logger.handlers):
+    root_logger.removeHandler(handler)
+for handler in root_handlers:
+    root_logger.addHandler(handler)
 
 
 logger = logging.getLogger(__name__)
@@ -59,50 +103,155 @@ warnings.filterwarnings(
 
 EXCHANGE_LIST = ["nas", "nyse", "tsx"]
 RAND_VALUE = 0  # Number of random stocks to analyze, mainly used for testing
+# quoteSummary module profile for existing stocks, new stocks always use "full"
+REFRESH_MODULE_PROFILE = os.getenv("REFRESH_MODULE_PROFILE", "full")
+RUN_VALUATION_GRID = os.getenv("RUN_VALUATION_GRID", "false").lower() == "true"
+
+profiler = SymbolProfiler()
+lanes = create_exchange_lanes()
+exporter = create_run_exporter()
+spool = create_write_spool()
+fetch_worker = create_fetch_worker(profiler)
+memory_watermarks = MemoryWatermarks()
+deadline_overruns: dict[str, int] = {}  # Stage -> symbols that ran out of time in it
 
 
-def process_stock(symbol: str, exchange: str, database: DatabaseHandler):
+def process_stock(
+    symbol: str, exchange: str, database: DatabaseHandler, module_profile: str = "full"
+):
     """Process and update stock information."""
+    start = time.perf_counter()
+    with log_context(symbol=symbol, exchange=exchange):
+        # The fetch worker profiles the symbols it fetches itself
+        with stage_times() as times:
+            with nullcontext() if fetch_worker else profiler.profile(symbol, exchange):
+                outcome = update_stock(symbol, exchange, database, module_profile)
+        duration = round(time.perf_counter() - start, 3)
+        logger.info(
+            f"Processed {symbol} in {duration}s: {outcome}",
+            extra={
+                "duration": duration,
+                "stages": {name: round(elapsed, 3) for name, elapsed in times.items()},
+            },
+        )
+    lanes.record(exchange, outcome, duration)
+    memory_watermarks.record(fetch_worker)
+
+
+def update_stock(
+    symbol: str, exchange: str, database: DatabaseHandler, module_profile: str = "full"
+) -> str:
+    """Fetch a stock and store it, storing whatever data is available for bad stocks.
+
+    Returns the outcome counted in the lane stats of the exchange.
+    """
     try:
-        stock = StockFactory.create_stock(symbol, exchange)
-        database.update_stock_in_database(stock)
+        # The deadline covers fetching only, a fetched stock is never dropped by it
+        if fetch_worker:
+            stock = fetch_worker.fetch(symbol, exchange, module_profile)
+        else:
+            stock = fetch_stock(symbol, exchange, module_profile)
+        store_stock(stock, database)
+        return "stored"
+    except DeadlineExceeded as e:
+        logger.error(f"DEADLINE - {symbol}: {e.message}")
+        deadline_overruns[e.stage] = deadline_overruns.get(e.stage, 0) + 1
+        return "deadline"
     except BadStock as e:
         logger.error(f"BADSTOCK - {symbol}: {e.message}")
         bad_stock = StockFactory.create_stock_from_data(symbol, exchange, e.stock_data)
-        database.update_stock_in_database(bad_stock)
-        pass
+        store_stock(bad_stock, database)
+        return "bad_stock"
     except Exception as e:
+        if is_transient(e):
+            lanes.retry(symbol, exchange, e, module_profile)
+            return "transient"
         logger.error(f"An unexpected error occurred: {e}")
         # bad_stock = StockFactory.create_stock_from_data(symbol, exchange, StockData())
         # database.update_stock_in_database(bad_stock)
-        pass
+        return "error"
+
+
+def store_stock(stock: Stock, database: DatabaseHandler):
+    """Store the stock in the database and add it to the run export once stored.
+
+    With the spool enabled the stock is appended to it, and the spool flusher
+    stores and exports it in the background.
+    """
+    if spool:
+        with stage("spool"):
+            spool.append(stock)
+        return
+    with stage("db"):
+        stored = database.update_stock_in_database(stock)
+    if stored:
+        export_stock(stock)
+
+
+def export_stock(stock: Stock):
+    """Add a stored stock to the run export if enabled."""
+    if exporter:
+        with stage("export"):
+            exporter.add(stock)
+
+
+def process_ready_retries(database: DatabaseHandler):
+    """Retry the symbols whose cool-down has passed, sharing time between the lanes."""
+    for symbol, exchange, module_profile in lanes.schedule(lanes.pop_ready_retries()):
+        logger.info(f"Retrying stock {symbol} - {exchange}")
+        process_stock(symbol, exchange, database, module_profile)
+
+
+def progress(index: int, work: dict[str, Iterable]) -> str:
+    """Position in the work lists, with the total when it is known up front."""
+    if all(isinstance(symbols, Sized) for symbols in work.values()):
+        return f"{index + 1}/{sum(len(symbols) for symbols in work.values())}"
+    return str(index + 1)
 
 
 def analyze_and_update(rand_value: int, exchange_list: list[str]):
     """Perform the main analysis and update routine."""
     try:
-        database = DatabaseHandler()
+        # The spool keeps results while the database is down, so it is not needed to start
+        database = DatabaseHandler(require_connection=spool is None)
     except Exception as e:
         raise e
+    if spool:
+        spool.start(database, on_stored=export_stock)
 
-    new_symbols = database.fetch_new_symbols(exchange_list)
+    # Each exchange is a lane, the lanes are interleaved by their share of fetch time
+    if LONG_RUN_MODE:
+        new_work = {
+            exchange: database.iter_new_symbols([exchange])
+            for exchange in exchange_list
+        }
+    else:
+        new_work = group_by_exchange(database.fetch_new_symbols(exchange_list))
 
     if rand_value > 0:
-        new_symbols = random.sample(list(new_symbols), rand_value)
+        new_symbols = [item for symbols in new_work.values() for item in symbols]
+        new_work = group_by_exchange(random.sample(new_symbols, rand_value))
 
     # Process new symbols first
-    for i, (symbol, exchange) in enumerate(new_symbols):
+    for i, (symbol, exchange) in enumerate(lanes.schedule(new_work)):
         logger.info(
-            f"Processing new stock {symbol} - {exchange} : {i + 1}/{len(new_symbols)}"
+            f"Processing new stock {symbol} - {exchange} : {progress(i, new_work)}"
         )
         process_stock(symbol, exchange, database)
+        process_ready_retries(database)
 
     #Process existing symbols next
     logger.info("Fetching existing stocks")
-    existing_symbols = database.fetch_existing_symbols()
-    for i, (symbol, exchange) in enumerate(list(existing_symbols)):
+    if LONG_RUN_MODE:
+        existing_work = {
+            exchange: database.iter_existing_symbols(exchange)
+            for exchange in database.fetch_stock_exchanges()
+        }
+    else:
+        existing_work = group_by_exchange(database.fetch_existing_symbols())
+    for i, (symbol, exchange) in enumerate(lanes.schedule(existing_work)):
         logger.info(
-            f"Processing existing stock {symbol} - {exchange} : {i + 1}/{len(existing_symbols)}"
+            f"Processing existing stock {symbol} - {exchange} : {progress(i, existing_work)}"
         )
 
         # TODO: Implement database check for last_updated rather than initializing every stock
@@ -110,7 +259,41 @@ def analyze_and_update(rand_value: int, exchange_list: list[str]):
         #     logger.info(f"Stock {stock.symbol} was recently updated")
         #     continue
 
-        process_stock(symbol, exchange, database)
+        process_stock(symbol, exchange, database, REFRESH_MODULE_PROFILE)
+        process_ready_retries(database)
+
+    # Drain the remaining retries, attempts are bounded so this terminates
+    while lanes.pending_retries():
+        logger.info(f"Waiting on {lanes.pending_retries()} symbols to retry")
+        lanes.wait_for_next_retry()
+        process_ready_retries(database)
+
+    if fetch_worker:
+        fetch_worker.close()
+
+    given_up = lanes.given_up()
+    if given_up:
+        logger.error(f"{len(given_up)} symbols failed after retries: {given_up}")
+    lanes.log_summary()
+
+    if deadline_overruns:
+        logger.warning(
+            f"{sum(deadline_overruns.values())} symbols exceeded their deadline, "
+            f"by stage: {deadline_overruns}"
+        )
+
+    if spool:
+        spool.close()
+    database.flush_history()
+    if exporter:
+        exporter.close()
+    database.drop_old_history_partitions()
+
+    if RUN_VALUATION_GRID:
+        logger.info("Calculating valuation sensitivity grid")
+        run_valuation_grid(database)
+
+    profiler.write_report(log_dir)
 
 if __name__ == "__main__":
     
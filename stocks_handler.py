@@ -1,16 +1,33 @@
 from dataclasses import dataclass
 from enum import Enum
+import numpy as np
+import os
 import pandas as pd
 import time
 import logging
 import yahooquery
 from datetime import datetime
 import feedparser
-from utils import BadStock
+import requests
+from utils import BadStock, DeadlineExceeded, TransientError, is_transient_message
 from feedparser import FeedParserDict
+from profiler import stage
+from yahoo_parser import (
+    ANNUAL_PERIOD,
+    FinancialTable,
+    fetch_chart,
+    fetch_financial_table,
+    history_closes,
+    nanmean,
+)
+from yahoo_session import get_yahoo_session
 
 logger = logging.getLogger(__name__)
 
+# "fast" reads the timeseries and chart JSON directly, "pandas" goes through
+# yahooquery's DataFrames
+YAHOO_PARSER = os.getenv("YAHOO_PARSER", "fast")
+
 class StockQuality(Enum):
     GREAT = 1
     GOOD = 2
@@ -123,6 +140,53 @@ class Stock:
 class StockFactory:
     DISCOUNT_RATE = 0.09
 
+    # quoteSummary modules read for each StockData field. Financial values come
+    # from the timeseries first and fall back to the module in key_paths.
+    FIELD_MODULES = {
+        "current_price": ["price"],
+        "title": ["quoteType"],
+        "industry": ["assetProfile"],
+        "esg_score": ["esgScores"],
+        "controversy": ["esgScores"],
+        "summary": ["summaryProfile"],
+        "growth_estimate": ["earningsTrend"],
+        "current_eps": ["defaultKeyStatistics"],
+        "shares_outstanding_raw": ["defaultKeyStatistics"],
+        "trailing_dividend_rate_raw": ["summaryDetail"],
+        "market_cap": ["summaryDetail"],
+        "revenue": ["incomeStatementHistory"],
+        "net_income": ["incomeStatementHistory"],
+        "assets": ["balanceSheetHistoryQuarterly"],
+        "liabilities": ["balanceSheetHistory"],
+        "debt": ["financialData"],
+        "long_term_debt": ["balanceSheetHistoryQuarterly"],
+        "cash_raw_eq": ["balanceSheetHistory"],
+        "fcf_raw_value": ["cashflowStatementHistoryQuarterly"],
+        "stockholders_equity_raw": ["balanceSheetHistory"],
+    }
+    # Every timeseries type is fetched in one request per symbol, BasicEPS feeds
+    # the historical PE and the rest the financial values and historical ROE
+    FINANCIAL_TYPES = [
+        "BasicEPS",
+        "MarketCap",
+        "TotalRevenue",
+        "NetIncome",
+        "TotalAssets",
+        "TotalLiabilitiesNetMinorityInterest",
+        "TotalDebt",
+        "LongTermDebt",
+        "CashAndCashEquivalents",
+        "FreeCashFlow",
+        "StockholdersEquity",
+    ]
+    # Descriptive fields rarely change, the database keeps their previous values
+    # when a profile does not fetch them
+    DESCRIPTIVE_FIELDS = ["title", "industry", "esg_score", "controversy", "summary"]
+    MODULE_PROFILES = {
+        "full": list(FIELD_MODULES),
+        "valuation": sorted(set(FIELD_MODULES) - set(DESCRIPTIVE_FIELDS)),
+    }
+
     key_paths = {
         "MarketCap": ["summaryDetail", "marketCap"],
         "TotalRevenue": [
@@ -171,6 +235,14 @@ class StockFactory:
         ],
     }
 
+    @staticmethod
+    def get_profile_modules(module_profile: str) -> list[str]:
+        """Get the quoteSummary modules needed for the fields of a module profile."""
+        modules = set()
+        for field in StockFactory.MODULE_PROFILES[module_profile]:
+            modules.update(StockFactory.FIELD_MODULES[field])
+        return sorted(modules)
+
     @staticmethod
     def validate_growth_estimate(stock: Stock):
         """Validate the growth estimate of the stock."""
@@ -255,27 +327,74 @@ class StockFactory:
         )
 
     @staticmethod
-    def fetch_historical_pe(ticker: yahooquery.Ticker) -> float | None:
-        """Fetch 5-year historical PE from Yahoo Finance."""
+    def fetch_financial_data(
+        ticker: yahooquery.Ticker,
+    ) -> FinancialTable | dict | str:
+        """Fetch the FINANCIAL_TYPES timeseries, errors come back as in yahooquery."""
+        if YAHOO_PARSER != "pandas":
+            return fetch_financial_table(ticker, StockFactory.FINANCIAL_TYPES)
+
+        financial_data = ticker.get_financial_data(
+            StockFactory.FINANCIAL_TYPES, trailing=True
+        )
+        if isinstance(financial_data, pd.DataFrame):
+            return FinancialTable.from_dataframe(financial_data)
+        return financial_data
+
+    @staticmethod
+    def yahoo_error(result, yh_symbol: str) -> str | None:
+        """The error message of a yahooquery result, None if it is not an error.
+
+        yahooquery returns errors as a message string, either on its own or
+        in a dict keyed by the symbol.
+        """
+        if isinstance(result, dict):
+            result = result.get(yh_symbol, result.get("error"))
+        return result if isinstance(result, str) else None
+
+    @staticmethod
+    def fetch_history_closes(ticker: yahooquery.Ticker) -> np.ndarray:
+        """Fetch the quarterly close prices of the last 5 years."""
+        yh_symbol = ticker.symbols[0]
+        yahoo_session = get_yahoo_session()
+        params = {"range": "5y", "interval": "3mo"}
+        for _ in range(2):
+            chart = fetch_chart(ticker, params["range"], params["interval"])
+            # Retry once straight away if the crumb had expired
+            error = StockFactory.yahoo_error(chart, yh_symbol)
+            if not yahoo_session.refresh_if_auth_error(error):
+                break
+
+        if YAHOO_PARSER != "pandas":
+            return history_closes(chart)
+        # What ticker.history builds, which drops the error message of a failed chart
+        history = ticker._historical_data_to_dataframe({yh_symbol: chart}, params, True)
+        return history["close"].to_numpy(dtype=np.float64)
+
+    @staticmethod
+    def fetch_historical_pe(
+        ticker: yahooquery.Ticker, financial_data: FinancialTable
+    ) -> float | None:
+        """Fetch 5-year historical PE from Yahoo Finance.
+
+        The EPS comes from the BasicEPS column of the symbol's timeseries data.
+        """
         try:
-            avg_historical_price = ticker.history(period="5y", interval="3mo")[
-                "close"
-            ].mean()
-            basic_eps = ticker.get_financial_data("BasicEPS")
-            if isinstance(basic_eps, str):
-                raise AttributeError(basic_eps)
-            avg_historical_eps = basic_eps.get(
-                "BasicEPS"
-            , []).mean()
+            with stage("history", network=True):
+                closes = StockFactory.fetch_history_closes(ticker)
+            avg_historical_price = nanmean(closes)
+            avg_historical_eps = financial_data.mean("BasicEPS")
+            if avg_historical_eps is None:
+                logger.error("Error fetching historical PE: no BasicEPS data")
+                return None
             historical_pe = avg_historical_price / avg_historical_eps
             return float(historical_pe)
-        except AttributeError as e:
-            logger.error(f"Historical ROE Error: {e}")
-            return None
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error fetching historical PE: {e}")
             return None
-        
+
     @staticmethod
     def extract_from_dict(data_dict: dict, key_path: list) -> float | None:
         try:
@@ -290,39 +409,29 @@ class StockFactory:
 
     @staticmethod
     def get_financial_value(
-        df: pd.DataFrame, column_name: str, basic_stock_info: dict
+        financial_data: FinancialTable, column_name: str, basic_stock_info: dict
     ) -> float | None:
         try:
             if column_name == "HistoricalROE":
-                df_12m = df[df['periodType'] == '12M']
-                if df_12m.empty:
-                    return None
-                
                 roe_values = []
-                for i in range(len(df_12m)):
-                    net_income = df_12m.iloc[i].get("NetIncome")
-                    equity = df_12m.iloc[i].get("StockholdersEquity")
-                    
-                    if pd.notna(net_income) and pd.notna(equity) and equity != 0:
+                for row in financial_data.rows(ANNUAL_PERIOD):
+                    net_income = row.get("NetIncome", np.nan)
+                    equity = row.get("StockholdersEquity", np.nan)
+
+                    if not (np.isnan(net_income) or np.isnan(equity)) and equity != 0:
                         roe = net_income / equity
                         roe_values.append(roe)
-                
+
                 if roe_values:
                     return float(sum(roe_values) / len(roe_values))
                 return None
 
-            if column_name in df.columns:
-                df_values = df[column_name].dropna()
-                if not df_values.empty:
-                    return float(df_values.iloc[-1])
+            value = financial_data.last(column_name)
+            if value is not None:
+                return value
 
             if column_name == "FreeCashFlow":
-                fcf_value = StockFactory.calculate_free_cash_flow(basic_stock_info)
-                if not fcf_value:
-                    fcf_value = df[df['periodType'] == 'TTM'].iloc[0].get(column_name)
-                    if pd.notna(fcf_value):
-                        return float(fcf_value)
-                return fcf_value
+                return StockFactory.calculate_free_cash_flow(basic_stock_info)
 
             return StockFactory.extract_from_dict(
                 basic_stock_info, StockFactory.key_paths.get(column_name, [])
@@ -331,7 +440,6 @@ class StockFactory:
             logger.error(f"Error fetching financial value for {column_name}: {e}")
             return None
 
-
     @staticmethod
     def calculate_free_cash_flow(basic_stock_info: dict) -> float | None:
         try:
@@ -353,7 +461,12 @@ class StockFactory:
     @staticmethod
     def get_news_from_yahoo(ticker_symbol: str) -> list[News]:
         url = f"https://feeds.finance.yahoo.com/rss/2.0/headline?s={ticker_symbol}"
-        feed: FeedParserDict = feedparser.parse(url)
+        try:
+            response = get_yahoo_session().get(url)
+        except requests.RequestException as e:
+            logger.error(f"Error fetching news: {e}")
+            return []
+        feed: FeedParserDict = feedparser.parse(response.content)
 
         news_list = []
         for entry in feed.entries:
@@ -377,36 +490,41 @@ class StockFactory:
         return news_list
 
     @staticmethod
-    def create_stock(symbol: str, exchange: str) -> Stock:
-        """Create a stock object with the given symbol and exchange."""
+    def create_stock(symbol: str, exchange: str, module_profile: str = "full") -> Stock:
+        """Create a stock object with the given symbol and exchange.
+
+        Args:
+            symbol (str): The stock symbol.
+            exchange (str): The exchange where the stock is listed.
+            module_profile (str, optional): Key of MODULE_PROFILES, selects the fields to fetch. Defaults to "full".
+        """
         yh_symbol = get_stock_symbol_for_yahoo(symbol, exchange)
-        ticker = yahooquery.Ticker(yh_symbol)
+        yahoo_session = get_yahoo_session()
+        ticker = yahoo_session.ticker(yh_symbol)
+        modules = StockFactory.get_profile_modules(module_profile)
 
         stock_data = StockData()
-        time_interval = {0: 300, 1: 600, 2: 1200}
-        for i, interval in list(time_interval.items()):
-            basic_ticker: dict = ticker.all_modules
+        for _ in range(2):
+            with stage("quote_summary", network=True):
+                basic_ticker: dict = ticker.get_modules(modules)
             if not isinstance(basic_ticker, dict):
                 raise BadStock(stock_data, f"Error fetching data for {symbol}")
-            
-            if isinstance(basic_ticker[yh_symbol], str):
-                if "for input string" in basic_ticker[yh_symbol].lower():
-                   logger.error(f"Iteration {i+1} - earningsTrend returning error. Sleeping for {interval}s...")
-                   time.sleep(interval)
-            else:
-                break
 
-        if isinstance(basic_ticker[yh_symbol], str):
-            if "for input string" in basic_ticker[yh_symbol].lower():
-                raise ValueError(f"Error getting all modules: {basic_ticker[yh_symbol]}")
+            # Retry once straight away if the crumb had expired
+            if not yahoo_session.refresh_if_auth_error(basic_ticker[yh_symbol]):
+                break
 
         basic_ticker = basic_ticker[yh_symbol]
+        if isinstance(basic_ticker, str) and is_transient_message(basic_ticker):
+            # earningsTrend intermittently fails with "for input string", retried later
+            raise TransientError(f"Error getting modules: {basic_ticker}")
         if not isinstance(basic_ticker, dict):
             if isinstance(basic_ticker, str):
                 raise BadStock(stock_data, basic_ticker)
             raise BadStock(stock_data, f"Error fetching data for {symbol}")
 
-        stock_data.news = StockFactory.get_news_from_yahoo(yh_symbol)
+        with stage("news", network=True):
+            stock_data.news = StockFactory.get_news_from_yahoo(yh_symbol)
 
         current_price = basic_ticker.get("price", {}).get("regularMarketPrice", None)
         if current_price is None:
@@ -452,26 +570,22 @@ class StockFactory:
             "summaryDetail", {}
         ).get("trailingAnnualDividendRate", None)
 
-        stock_data.historical_pe = StockFactory.fetch_historical_pe(ticker)
-
-        financial_modules = [
-            "MarketCap",
-            "TotalRevenue",
-            "NetIncome",
-            "TotalAssets",
-            "TotalLiabilitiesNetMinorityInterest",
-            "TotalDebt",
-            "LongTermDebt",
-            "CashAndCashEquivalents",
-            "FreeCashFlow",
-            "StockholdersEquity",
-        ]
-        financial_ticker: pd.DataFrame = ticker.get_financial_data(
-            financial_modules, trailing=True
-        )
-        if not isinstance(financial_ticker, pd.DataFrame):
+        for _ in range(2):
+            with stage("financial_data", network=True):
+                financial_ticker = StockFactory.fetch_financial_data(ticker)
+            financial_error = StockFactory.yahoo_error(financial_ticker, yh_symbol)
+            if not yahoo_session.refresh_if_auth_error(financial_error):
+                break
+
+        if financial_error and is_transient_message(financial_error):
+            raise TransientError(f"Error fetching financial data: {financial_error}")
+        if not isinstance(financial_ticker, FinancialTable):
             raise BadStock(stock_data, f"Error fetching financial data for {symbol}")
 
+        stock_data.historical_pe = StockFactory.fetch_historical_pe(
+            ticker, financial_ticker
+        )
+
         stock_data.historical_roe = StockFactory.get_financial_value(
             financial_ticker, "HistoricalROE", basic_ticker
         )
@@ -511,31 +625,37 @@ class StockFactory:
 
         stock = Stock(symbol, exchange, stock_data)
 
+        with stage("valuation"):
+            StockFactory.calculate_valuations(stock)
+
+        return stock
+
+    @staticmethod
+    def calculate_valuations(stock: Stock) -> None:
+        """Calculate the PE, ROE and DCF values of the stock."""
         StockFactory.validate_growth_estimate(stock)
         if stock.stock_data.growth_estimate != 0:
             try:
                 StockFactory.calculate_pe_npv(StockFactory.DISCOUNT_RATE, stock)
             except Exception as e:
-                logger.error(f"Error calculating PE NPV for {symbol}: {e}")
+                logger.error(f"Error calculating PE NPV for {stock.symbol}: {e}")
                 stock.stock_data.pe = None
                 pass
 
             try:
                 StockFactory.calculate_roe_npv(StockFactory.DISCOUNT_RATE, stock)
             except Exception as e:
-                logger.error(f"Error calculating ROE NPV for {symbol}: {e}")
+                logger.error(f"Error calculating ROE NPV for {stock.symbol}: {e}")
                 stock.stock_data.roe = None
                 pass
 
             try:
                 StockFactory.calculate_dcf_npv(StockFactory.DISCOUNT_RATE, stock)
             except Exception as e:
-                logger.error(f"Error calculating DCF NPV for {symbol}: {e}")
+                logger.error(f"Error calculating DCF NPV for {stock.symbol}: {e}")
                 stock.stock_data.dcf = None
                 pass
 
-        return stock
-
     @staticmethod
     def create_stock_from_data(
         symbol: str, exchange: str, stock_data: StockData
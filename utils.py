@@ -28,3 +28,39 @@ class RecentlyUpdated(Exception):
         super().__init__(message)
 
 
+class TransientError(Exception):
+    """Exception raised when fetching a stock failed for a reason that may clear up."""
+
+    def __init__(self, message="A transient error occurred"):
+        super().__init__(message)
+        self.message = message
+
+
+TRANSIENT_ERROR_MESSAGES = (
+    "for input string",
+    "too many requests",
+    "429 client error",  # requests HTTPError, a bare 429 also matches symbols
+    "too many 429",  # urllib3 once the 429 retries are used up
+    "timed out",
+    "timeout",
+    "temporarily unavailable",
+    "service unavailable",
+    "bad gateway",
+    "invalid crumb",
+    "unauthorized",
+)
+
+
+def is_transient_message(message: str) -> bool:
+    """Check if an error message from Yahoo describes a transient failure."""
+    message = message.lower()
+    return any(transient in message for transient in TRANSIENT_ERROR_MESSAGES)
+
+
+class DeadlineExceeded(Exception):
+    """Exception raised when a symbol runs out of its time budget."""
+
+    def __init__(self, stage, message="The symbol deadline was exceeded"):
+        super().__init__(message)
+        self.stage = stage
+        self.message = message
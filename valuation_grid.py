@@ -0,0 +1,235 @@
+import logging
+import os
+import numpy as np
+
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Fixed assumptions shared with the StockFactory single-point valuations
+DCF_GROWTH_DECLINE = 0.05
+DCF_TERMINAL_MULTIPLE = 12
+PROJECTION_YEARS = 10
+PE_PROJECTION_YEARS = 5
+CHUNK_SIZE = 2000  # Stocks per batch, bounds the (stocks x scenarios x years) arrays
+
+
+def parse_float_list(value: str | None, default: list[float]) -> list[float]:
+    """Parse a comma separated list of floats, falling back to the default."""
+    if not value:
+        return default
+    try:
+        return [float(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        logger.error(f"Invalid float list '{value}', using default {default}")
+        return default
+
+
+DISCOUNT_RATES = parse_float_list(
+    os.getenv("VALUATION_DISCOUNT_RATES"), [0.07, 0.08, 0.09, 0.10, 0.11]
+)
+MARGINS_OF_SAFETY = parse_float_list(
+    os.getenv("VALUATION_MARGINS_OF_SAFETY"), [0.0, 0.15, 0.25, 0.35]
+)
+GROWTH_HAIRCUTS = parse_float_list(
+    os.getenv("VALUATION_GROWTH_HAIRCUTS"), [0.0, 0.25, 0.5, 0.75, 1.0]
+)
+
+
+@dataclass
+class ScenarioGrid:
+    discount_rate: np.ndarray
+    margin_of_safety: np.ndarray
+    growth_haircut: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.discount_rate)
+
+    @staticmethod
+    def build(
+        discount_rates: list[float],
+        margins_of_safety: list[float],
+        growth_haircuts: list[float],
+    ) -> "ScenarioGrid":
+        """Build the flattened cartesian product of all scenario parameters."""
+        rates, margins, haircuts = np.meshgrid(
+            np.asarray(discount_rates, dtype=np.float64),
+            np.asarray(margins_of_safety, dtype=np.float64),
+            np.asarray(growth_haircuts, dtype=np.float64),
+            indexing="ij",
+        )
+        return ScenarioGrid(rates.ravel(), margins.ravel(), haircuts.ravel())
+
+
+@dataclass
+class ValuationInputs:
+    """Column arrays of the stored valuation inputs, one entry per stock."""
+
+    symbols: list[tuple[str, str]]
+    current_eps: np.ndarray
+    historical_pe: np.ndarray
+    growth_estimate: np.ndarray
+    stockholders_equity: np.ndarray
+    shares_outstanding: np.ndarray
+    trailing_dividend_rate: np.ndarray
+    historical_roe: np.ndarray
+    fcf: np.ndarray
+    cash: np.ndarray
+    liabilities: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    @staticmethod
+    def from_db_rows(rows: list[dict]) -> "ValuationInputs":
+        """Create the input arrays from stocks table rows, missing values become NaN."""
+
+        def column(name: str) -> np.ndarray:
+            return np.array(
+                [np.nan if row[name] is None else row[name] for row in rows],
+                dtype=np.float64,
+            )
+
+        return ValuationInputs(
+            symbols=[(row["symbol"], row["exchange"]) for row in rows],
+            current_eps=column("currenteps"),
+            historical_pe=column("historicalpe"),
+            growth_estimate=column("growthestimate"),
+            stockholders_equity=column("stockholdersequityraw"),
+            shares_outstanding=column("sharesoutstandingraw"),
+            trailing_dividend_rate=column("trailingdividendrateraw"),
+            historical_roe=column("historicalroe"),
+            fcf=column("fcfrawvalue"),
+            cash=column("cashraweq"),
+            liabilities=column("liabilities"),
+        )
+
+    def chunk(self, start: int, stop: int) -> "ValuationInputs":
+        return ValuationInputs(
+            symbols=self.symbols[start:stop],
+            **{
+                name: getattr(self, name)[start:stop]
+                for name in self.__dataclass_fields__
+                if name != "symbols"
+            },
+        )
+
+
+@dataclass
+class ValuationGridResult:
+    """PE, ROE and DCF values shaped (stocks, scenarios)."""
+
+    symbols: list[tuple[str, str]]
+    pe: np.ndarray
+    roe: np.ndarray
+    dcf: np.ndarray
+
+
+def conservative_growth(inputs: ValuationInputs, grid: ScenarioGrid) -> np.ndarray:
+    """Growth per stock and scenario after the haircut and margin of safety.
+
+    Stocks without a growth estimate are not valued by StockFactory, so they
+    are set to NaN here to match.
+    """
+    growth = np.where(inputs.growth_estimate == 0, np.nan, inputs.growth_estimate)
+    return (
+        growth[:, None]
+        * (1 - grid.growth_haircut)[None, :]
+        * (1 - grid.margin_of_safety)[None, :]
+    )
+
+
+def calculate_pe_grid(
+    inputs: ValuationInputs, grid: ScenarioGrid, growth: np.ndarray
+) -> np.ndarray:
+    """Vectorized StockFactory.calculate_pe_npv."""
+    future_pe = (
+        (inputs.current_eps * inputs.historical_pe)[:, None]
+        * (1 + growth) ** PE_PROJECTION_YEARS
+    )
+    return future_pe / ((1 + grid.discount_rate) ** PE_PROJECTION_YEARS)[None, :]
+
+
+def calculate_roe_grid(
+    inputs: ValuationInputs, grid: ScenarioGrid, growth: np.ndarray
+) -> np.ndarray:
+    """Vectorized StockFactory.calculate_roe_npv."""
+    years = np.arange(1, PROJECTION_YEARS + 1)
+    rate = grid.discount_rate[None, :]
+    growth_factors = (1 + growth)[:, :, None] ** years  # (stocks, scenarios, years)
+    discount_factors = (1 + grid.discount_rate)[:, None] ** years  # (scenarios, years)
+
+    npv_dividends = (
+        inputs.trailing_dividend_rate[:, None, None] * growth_factors / discount_factors
+    ).sum(axis=2)
+
+    y10_equity = (
+        inputs.stockholders_equity / inputs.shares_outstanding
+    )[:, None] * growth_factors[:, :, -1]
+    required_value = y10_equity * inputs.historical_roe[:, None] / rate
+    npv_required_value = required_value / discount_factors[None, :, -1]
+    return npv_dividends + npv_required_value
+
+
+def calculate_dcf_grid(
+    inputs: ValuationInputs, grid: ScenarioGrid, growth: np.ndarray
+) -> np.ndarray:
+    """Vectorized StockFactory.calculate_dcf_npv."""
+    years = np.arange(1, PROJECTION_YEARS + 1)
+    decline = (1 - DCF_GROWTH_DECLINE) ** np.arange(PROJECTION_YEARS)
+    yearly_growth = 1 + growth[:, :, None] * decline
+    free_cash = inputs.fcf[:, None, None] * np.cumprod(yearly_growth, axis=2)
+    discount_factors = (1 + grid.discount_rate)[:, None] ** years
+
+    npv_free_cash = free_cash / discount_factors[None, :, :]
+    total_npv = npv_free_cash.sum(axis=2)
+    year_10_free_cash = npv_free_cash[:, :, -1] * DCF_TERMINAL_MULTIPLE
+    return (
+        total_npv
+        + year_10_free_cash
+        + (inputs.cash - inputs.liabilities)[:, None]
+    ) / inputs.shares_outstanding[:, None]
+
+
+def calculate_valuation_grid(
+    inputs: ValuationInputs, grid: ScenarioGrid
+) -> ValuationGridResult:
+    """Calculate PE, ROE and DCF values for every stock over every scenario.
+
+    Values that cannot be calculated (missing inputs, zero shares) are NaN.
+    """
+    pe = np.full((len(inputs), len(grid)), np.nan)
+    roe = np.full_like(pe, np.nan)
+    dcf = np.full_like(pe, np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for start in range(0, len(inputs), CHUNK_SIZE):
+            stop = start + CHUNK_SIZE
+            chunk = inputs.chunk(start, stop)
+            growth = conservative_growth(chunk, grid)
+            pe[start:stop] = calculate_pe_grid(chunk, grid, growth)
+            roe[start:stop] = calculate_roe_grid(chunk, grid, growth)
+            dcf[start:stop] = calculate_dcf_grid(chunk, grid, growth)
+
+    for values in (pe, roe, dcf):
+        values[~np.isfinite(values)] = np.nan
+        np.round(values, 2, out=values)
+
+    return ValuationGridResult(inputs.symbols, pe, roe, dcf)
+
+
+def run_valuation_grid(database, grid: ScenarioGrid | None = None) -> None:
+    """Calculate the valuation grid over the stored inputs and save it."""
+    if grid is None:
+        grid = ScenarioGrid.build(DISCOUNT_RATES, MARGINS_OF_SAFETY, GROWTH_HAIRCUTS)
+
+    inputs = database.fetch_valuation_inputs()
+    if not inputs:
+        logger.info("No stocks available for the valuation grid")
+        return
+
+    result = calculate_valuation_grid(inputs, grid)
+    database.save_valuation_grid(grid, result)
+    logger.info(
+        f"Valuation grid updated for {len(inputs)} stocks over {len(grid)} scenarios"
+    )
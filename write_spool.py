@@ -0,0 +1,279 @@
+import glob
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from typing import Callable, Iterator
+
+import psycopg2
+
+from database_handler import DatabaseHandler
+from stocks_handler import Stock
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool/")  # Empty disables the spool
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", "100"))
+SPOOL_FLUSH_INTERVAL = float(os.getenv("SPOOL_FLUSH_INTERVAL", "5"))  # Seconds
+SPOOL_MAX_BACKOFF = 300  # Seconds between attempts while the database is down
+SPOOL_DRAIN_TIMEOUT = float(os.getenv("SPOOL_DRAIN_TIMEOUT", "300"))
+SPOOL_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Each record is its payload length and CRC32 followed by the pickled Stock
+RECORD_HEADER = struct.Struct(">II")
+# Errors that mean the database is unavailable rather than the batch being bad
+UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def read_records(path: str, offset: int, end: int) -> Iterator[tuple[int, Stock]]:
+    """Read the records of a segment between two offsets.
+
+    Yields each stock with the offset just past its record. Stops at a record
+    that is cut short or fails its checksum, which is what a crash in the
+    middle of an append leaves behind.
+    """
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while offset < end:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                logger.warning(f"Truncated spool record in {path} at {offset}")
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.warning(f"Corrupt spool record in {path} at {offset}")
+                return
+            offset += RECORD_HEADER.size + length
+            try:
+                yield offset, pickle.loads(payload)
+            except (pickle.UnpicklingError, AttributeError, ImportError) as e:
+                logger.error(f"Skipping unreadable spool record in {path}: {e}")
+
+
+class WriteSpool:
+    """Write-behind log of stored stocks, replayed into the database in the background.
+
+    Stocks are appended to fsync'd segment files, so fetching never waits on
+    the database and nothing fetched is lost while it is slow or down. A
+    flusher thread writes them to the database in batches, keeping the offset
+    reached in each segment so a restart resumes where it stopped. Segments
+    left by an earlier run are replayed first.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        batch_size: int = SPOOL_BATCH_SIZE,
+        flush_interval: float = SPOOL_FLUSH_INTERVAL,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.database: DatabaseHandler | None = None
+        self.on_stored: Callable[[Stock], None] | None = None
+        self.available = True
+        self.appended = 0
+        self.stored = 0
+        self.rejected = 0
+
+        segments = self.segments()
+        self.sequence = self.segment_sequence(segments[-1]) + 1 if segments else 1
+        if segments:
+            logger.info(f"Found {len(segments)} spool segments from an earlier run")
+        self.active_path = ""
+        self.active_size = 0
+        self.active = None
+        self.open_segment()
+
+    def segment_path(self, sequence: int) -> str:
+        return os.path.join(self.directory, f"segment-{sequence:08d}.log")
+
+    @staticmethod
+    def segment_sequence(path: str) -> int:
+        return int(os.path.basename(path)[len("segment-") : -len(".log")])
+
+    def segments(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "segment-*.log")))
+
+    def open_segment(self) -> None:
+        self.active_path = self.segment_path(self.sequence)
+        self.active = open(self.active_path, "ab")
+        self.active_size = self.active.tell()
+        self.sequence += 1
+
+    def append(self, stock: Stock) -> None:
+        """Durably append a stock, returning once it is on disk."""
+        payload = pickle.dumps(stock, protocol=pickle.HIGHEST_PROTOCOL)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            self.active.write(record)
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active_size += len(record)
+            self.appended += 1
+            if self.active_size >= SPOOL_SEGMENT_BYTES:
+                self.active.close()
+                self.open_segment()
+        if self.appended % self.batch_size == 0:
+            self.wake.set()
+
+    def read_offset(self, segment: str) -> int:
+        try:
+            with open(segment + ".offset", "r") as file:
+                return int(file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save_offset(self, segment: str, offset: int) -> None:
+        temp_path = segment + ".offset.tmp"
+        with open(temp_path, "w") as file:
+            file.write(str(offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, segment + ".offset")
+
+    def remove_segment(self, segment: str) -> None:
+        for path in (segment, segment + ".offset"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def set_available(self, available: bool, reason: str = "") -> None:
+        """Track the database state, logging only when it changes."""
+        if self.available and not available:
+            logger.warning(
+                f"Database unavailable, keeping stocks in the spool: {reason}"
+            )
+        elif available and not self.available:
+            logger.info("Database available again, replaying the spool")
+        self.available = available
+
+    def write_batch(self, batch: list[Stock]) -> bool:
+        """Write a batch to the database, False if the database is unavailable."""
+        try:
+            rejected = self.database.update_stocks_in_database(batch)
+        except UNAVAILABLE_ERRORS as e:
+            self.set_available(False, str(e))
+            return False
+
+        self.set_available(True)
+        self.rejected += len(rejected)
+        rejected_ids = {id(stock) for stock in rejected}
+        for stock in batch:
+            if id(stock) in rejected_ids:
+                continue
+            self.stored += 1
+            if self.on_stored:
+                try:
+                    self.on_stored(stock)
+                except Exception as e:
+                    logger.error(f"Error handling stored stock {stock.symbol}: {e}")
+        return True
+
+    def replay(self) -> bool:
+        """Write everything spooled so far, False if the database is unavailable."""
+        if not self.database.ensure_fetcher_tables():
+            self.set_available(False, "unable to create the fetcher tables")
+            return False
+
+        for segment in self.segments():
+            with self.lock:
+                sealed = segment != self.active_path
+                end = os.path.getsize(segment) if sealed else self.active_size
+
+            offset = self.read_offset(segment)
+            batch: list[Stock] = []
+            for next_offset, stock in read_records(segment, offset, end):
+                batch.append(stock)
+                if len(batch) >= self.batch_size:
+                    if not self.write_batch(batch):
+                        return False
+                    self.save_offset(segment, next_offset)
+                    offset = next_offset
+                    batch = []
+            if batch:
+                if not self.write_batch(batch):
+                    return False
+                self.save_offset(segment, next_offset)
+
+            if sealed:
+                self.remove_segment(segment)
+        return True
+
+    def run(self) -> None:
+        delay = self.flush_interval
+        while not self.stopping.is_set():
+            self.wake.wait(delay)
+            self.wake.clear()
+            try:
+                replayed = self.replay()
+            except Exception as e:
+                logger.error(f"Error replaying the spool: {e}")
+                replayed = False
+            delay = (
+                self.flush_interval if replayed else min(delay * 2, SPOOL_MAX_BACKOFF)
+            )
+
+    def start(
+        self, database: DatabaseHandler, on_stored: Callable[[Stock], None] | None
+    ) -> None:
+        """Start replaying into the database, on_stored is called for each stored stock."""
+        self.database = database
+        self.on_stored = on_stored
+        self.thread = threading.Thread(
+            target=self.run, name="spool-flusher", daemon=True
+        )
+        self.thread.start()
+
+    def close(self, timeout: float = SPOOL_DRAIN_TIMEOUT) -> None:
+        """Stop the flusher and drain the spool, leaving it for the next run on timeout."""
+        self.stopping.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+
+        with self.lock:
+            self.active.close()
+            self.open_segment()
+
+        deadline = time.monotonic() + timeout
+        delay = 1.0
+        while self.database and not self.replay():
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, SPOOL_MAX_BACKOFF)
+
+        with self.lock:
+            self.active.close()
+            if os.path.getsize(self.active_path) == 0:
+                self.remove_segment(self.active_path)
+
+        pending = self.appended - self.stored - self.rejected
+        logger.info(
+            f"Spool: {self.appended} appended, {self.stored} stored, "
+            f"{self.rejected} rejected by the database"
+        )
+        if self.segments():
+            logger.warning(
+                f"{max(pending, 0)} spooled stocks of this run were not stored, "
+                f"they stay in {self.directory} for the next run"
+            )
+
+
+def create_write_spool() -> WriteSpool | None:
+    """Create the spool if SPOOL_DIR is set."""
+    if not SPOOL_DIR:
+        return None
+    return WriteSpool(SPOOL_DIR)
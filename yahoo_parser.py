@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+import yahooquery
+
+ANNUAL_PREFIX = "annual"
+TRAILING_PREFIX = "trailing"
+ANNUAL_PERIOD = "12M"
+LIVE_INDICE_TOLERANCE = 2  # Seconds, as in yahooquery
+ONE_DAY = 24 * 60 * 60
+
+
+def nanmean(values: np.ndarray) -> np.float64:
+    """Mean of the values that are not NaN, summed the same way as pandas."""
+    present = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(present, values, 0.0).sum() / present.sum()
+
+
+class FinancialTable:
+    """Annual and trailing timeseries values of one symbol, one row per period.
+
+    Rows are keyed and ordered by (asOfDate, periodType, currencyCode) and every
+    type is a float column with NaN where a period has no value, which is the
+    shape yahooquery's get_financial_data pivots into a DataFrame.
+    """
+
+    def __init__(
+        self, keys: list[tuple[str, str, str]], columns: dict[str, np.ndarray]
+    ):
+        self.keys = keys
+        self.columns = columns
+
+    @classmethod
+    def from_timeseries(cls, results: list[dict]) -> "FinancialTable":
+        """Build the table from the results of a timeseries response."""
+        values: dict[tuple[str, str, str], dict[str, list[float]]] = {}
+        for result in results:
+            result_type = result["meta"]["type"][0]
+            data_type = result_type.removeprefix(ANNUAL_PREFIX).removeprefix(
+                TRAILING_PREFIX
+            )
+            for entry in result.get(result_type, []):
+                try:
+                    key = (
+                        entry["asOfDate"],
+                        entry["periodType"],
+                        entry["currencyCode"],
+                    )
+                except KeyError:
+                    continue
+                value = entry.get("reportedValue")
+                if isinstance(value, dict):
+                    value = value.get("raw")
+                if value is None:
+                    continue
+                values.setdefault(key, {}).setdefault(data_type, []).append(value)
+
+        keys = sorted(values)
+        data_types = sorted({data_type for row in values.values() for data_type in row})
+        columns = {
+            data_type: np.array(
+                [
+                    (
+                        np.mean(values[key][data_type])
+                        if data_type in values[key]
+                        else np.nan
+                    )
+                    for key in keys
+                ],
+                dtype=np.float64,
+            )
+            for data_type in data_types
+        }
+        return cls(keys, columns)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "FinancialTable":
+        """Build the table from the DataFrame returned by get_financial_data."""
+        keys = list(
+            zip(
+                df["asOfDate"].dt.strftime("%Y-%m-%d"),
+                df["periodType"],
+                df["currencyCode"],
+            )
+        )
+        index_columns = {"asOfDate", "periodType", "currencyCode"}
+        columns = {
+            column: df[column].to_numpy(dtype=np.float64)
+            for column in df.columns
+            if column not in index_columns
+        }
+        return cls(keys, columns)
+
+    def last(self, data_type: str) -> float | None:
+        """The value of the latest period that has one."""
+        values = self.columns.get(data_type)
+        if values is None:
+            return None
+        values = values[~np.isnan(values)]
+        return float(values[-1]) if len(values) else None
+
+    def mean(self, data_type: str) -> np.float64 | None:
+        """The mean over every period with a value, None if the type is missing."""
+        values = self.columns.get(data_type)
+        if values is None:
+            return None
+        return nanmean(values)
+
+    def rows(self, period_type: str) -> list[dict[str, float]]:
+        """The values of each period of a period type, NaN where missing."""
+        return [
+            {data_type: values[i] for data_type, values in self.columns.items()}
+            for i, key in enumerate(self.keys)
+            if key[1] == period_type
+        ]
+
+
+def fetch_financial_table(
+    ticker: yahooquery.Ticker, types: list[str]
+) -> FinancialTable | dict | str:
+    """Fetch annual and trailing timeseries values without building DataFrames.
+
+    Mirrors ticker.get_financial_data(types, trailing=True), including its
+    error results: the raw response dict when Yahoo returns an error for the
+    symbol, and a message string when there is no data at all.
+    """
+    prefixed_types = [f"{ANNUAL_PREFIX}{t}" for t in types] + [
+        f"{TRAILING_PREFIX}{t}" for t in types
+    ]
+    data = ticker._get_data(
+        "fundamentals", {"type": ",".join(prefixed_types)}, list_result=True
+    )
+
+    results = []
+    for symbol_results in data.values():
+        if isinstance(symbol_results, str) or symbol_results[0].get("description"):
+            return data
+        for result in symbol_results:
+            result_type = result["meta"]["type"][0]
+            entries = result.get(result_type)
+            if entries is None:
+                continue
+            # yahooquery gives up on the whole response when an entry is null
+            if any(not isinstance(entry, dict) for entry in entries):
+                return data
+            if not any("reportedValue" in entry for entry in entries):
+                continue
+            results.append(result)
+
+    if not results:
+        return f"Cash Flow data unavailable for {', '.join(ticker._symbols)}"
+    return FinancialTable.from_timeseries(results)
+
+
+def history_closes(chart: dict) -> np.ndarray:
+    """Close prices of a daily or longer chart result, NaN where missing.
+
+    Drops a trailing live row that duplicates the previous period the same way
+    yahooquery's history does.
+    """
+    if not isinstance(chart, dict) or "timestamp" not in chart:
+        return np.array([], dtype=np.float64)
+
+    quote = chart["indicators"]["quote"][0]
+    series = [
+        quote[column]
+        for column in ("open", "high", "low", "close", "volume")
+        if column in quote
+    ]
+    if "adjclose" in chart["indicators"]:
+        series.append(chart["indicators"]["adjclose"][0]["adjclose"])
+    event_times = {
+        int(event_time)
+        for event, event_data in chart.get("events", {}).items()
+        if event in ("dividends", "splits")
+        for event_time in event_data
+    }
+
+    # Rows without any value are dropped before the live row check
+    timestamps = []
+    closes = []
+    for i, timestamp in enumerate(chart["timestamp"]):
+        if timestamp not in event_times and all(
+            i >= len(values) or values[i] is None for values in series
+        ):
+            continue
+        timestamps.append(timestamp)
+        close = (
+            quote["close"][i] if "close" in quote and i < len(quote["close"]) else None
+        )
+        closes.append(np.nan if close is None else close)
+
+    last_trade = chart.get("meta", {}).get("regularMarketTime")
+    if (
+        last_trade is not None
+        and len(timestamps) > 1
+        and timestamps[-1] >= last_trade - LIVE_INDICE_TOLERANCE
+        and timestamps[-1] <= timestamps[-2] + ONE_DAY
+    ):
+        closes = closes[:-1]
+    return np.array(closes, dtype=np.float64)
+
+
+def fetch_chart(ticker: yahooquery.Ticker, period: str, interval: str) -> dict | str:
+    """Fetch the chart result of the ticker's symbol, or Yahoo's error message.
+
+    Pass the result to history_closes, which skips building the history
+    DataFrame.
+    """
+    data = ticker._get_data("chart", {"range": period, "interval": interval})
+    symbol = ticker._symbols[0]
+    return data.get(symbol, data.get("error", f"No chart data for {symbol}"))
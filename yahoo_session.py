@@ -0,0 +1,318 @@
+import logging
+import os
+import threading
+import time
+import yahooquery
+import requests
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from deadline import (
+    HEDGE_PERCENTILE,
+    HEDGE_REQUESTS,
+    Deadline,
+    LatencyTracker,
+    current_deadline,
+)
+from urllib.parse import urlsplit, urlunsplit
+from urllib3.util.retry import Retry
+from urllib3.util.timeout import Timeout
+from yahooquery.utils import (
+    DEFAULT_TIMEOUT,
+    TimeoutHTTPAdapter,
+    get_crumb,
+    initialize_session,
+    setup_session,
+)
+
+logger = logging.getLogger(__name__)
+
+AUTH_ERROR_MESSAGES = ("invalid crumb", "unauthorized", "invalid cookie")
+
+# Sends every Yahoo request to this server instead, e.g. the load test stand-in
+YAHOO_BASE_URL = os.getenv("YAHOO_BASE_URL")
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", str(DEFAULT_TIMEOUT)))
+HEDGE_WORKERS = 4  # Two per in-flight request, the fetcher sends one at a time
+
+
+class DeadlineRetry(Retry):
+    """Retry that gives up once the symbol deadline leaves no time for the next attempt.
+
+    Backoff and Retry-After waits are capped to the time left, urllib3 would
+    otherwise sleep through the deadline between attempts.
+    """
+
+    deadline: Deadline | None = None
+
+    def new(self, **kwargs) -> "DeadlineRetry":
+        retry = super().new(**kwargs)
+        retry.deadline = self.deadline
+        return retry
+
+    def for_deadline(self, deadline: Deadline) -> "DeadlineRetry":
+        retry = self.new()
+        retry.deadline = deadline
+        return retry
+
+    def remaining(self, wait: float) -> float:
+        if self.deadline is None:
+            return wait
+        return max(0.0, min(wait, self.deadline.remaining()))
+
+    def is_exhausted(self) -> bool:
+        if self.deadline is not None and (
+            self.deadline.remaining() <= self.get_backoff_time()
+        ):
+            return True
+        return super().is_exhausted()
+
+    def get_backoff_time(self) -> float:
+        return self.remaining(super().get_backoff_time())
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else self.remaining(retry_after)
+
+
+class DeadlineTimeout(Timeout):
+    """Timeout that caps every attempt of a request, retries included, to the deadline.
+
+    urllib3 clones the timeout for each attempt, so the cap is applied there
+    and a request whose deadline has passed fails before it is sent again.
+    """
+
+    def __init__(self, deadline: Deadline, timeout: float | tuple):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        super().__init__(connect=connect, read=read)
+        self.deadline = deadline
+
+    def clone(self) -> Timeout:
+        self.deadline.check()
+        remaining = self.deadline.remaining()
+        return Timeout(
+            connect=min(self._connect, remaining),
+            read=min(self._read, remaining),
+        )
+
+
+class YahooAdapter(TimeoutHTTPAdapter):
+    """Transport adapter for every Yahoo request.
+
+    Caps each request attempt and its retries to what is left of the symbol
+    deadline and keeps the latency of each endpoint. With HEDGE_REQUESTS a GET
+    still pending after the endpoint's p95 latency is sent a second time and
+    the first response wins. YAHOO_BASE_URL rewrites the scheme and host of
+    every request.
+    """
+
+    def __init__(self, base_url: str | None = None, *args, **kwargs):
+        self.base_url = urlsplit(base_url) if base_url else None
+        self.latencies = LatencyTracker()
+        self.hedge_pool = ThreadPoolExecutor(
+            max_workers=HEDGE_WORKERS, thread_name_prefix="yahoo-hedge"
+        )
+        # Retries of the request being sent by each thread, bound to its deadline
+        self.request_retries = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def max_retries(self) -> Retry:
+        return getattr(self.request_retries, "retries", None) or self.default_retries
+
+    @max_retries.setter
+    def max_retries(self, retries: Retry) -> None:
+        self.default_retries = retries
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """Host and path of a request without the trailing symbol."""
+        url = urlsplit(url)
+        return url.netloc + url.path.rsplit("/", 1)[0]
+
+    def timed_send(self, request, endpoint: str, retries: Retry | None, **kwargs):
+        start = time.monotonic()
+        self.request_retries.retries = retries
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            self.request_retries.retries = None
+        self.latencies.record(endpoint, time.monotonic() - start)
+        return response
+
+    def send(self, request, **kwargs):
+        endpoint = self.endpoint(request.url)
+        if self.base_url:
+            url = urlsplit(request.url)
+            request.url = urlunsplit(
+                (self.base_url.scheme, self.base_url.netloc, url.path, url.query, "")
+            )
+
+        deadline = current_deadline()
+        retries = None
+        if deadline is not None:
+            deadline.check()
+            kwargs["timeout"] = DeadlineTimeout(
+                deadline, kwargs.get("timeout") or self.timeout
+            )
+            if isinstance(self.default_retries, DeadlineRetry):
+                retries = self.default_retries.for_deadline(deadline)
+
+        hedge_after = None
+        if HEDGE_REQUESTS and request.method == "GET":
+            hedge_after = self.latencies.percentile(endpoint, HEDGE_PERCENTILE)
+        try:
+            if hedge_after is None:
+                return self.timed_send(request, endpoint, retries, **kwargs)
+            return self.hedged_send(request, endpoint, hedge_after, retries, **kwargs)
+        except requests.RequestException:
+            # A timeout cut short by the deadline is reported as the deadline
+            if deadline is not None:
+                deadline.check()
+            raise
+
+    def hedged_send(
+        self,
+        request,
+        endpoint: str,
+        hedge_after: float,
+        retries: Retry | None,
+        **kwargs,
+    ):
+        """Send the request and, if it is slower than hedge_after, a duplicate of it."""
+        primary = self.hedge_pool.submit(
+            self.timed_send, request, endpoint, retries, **kwargs
+        )
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        logger.debug(f"Hedging request to {endpoint} after {hedge_after:.2f}s")
+        hedge = self.hedge_pool.submit(
+            self.timed_send, request.copy(), endpoint, retries, **kwargs
+        )
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                # The slower copy is closed once it finishes
+                for loser in pending:
+                    loser.add_done_callback(close_response)
+                return future.result()
+        raise error
+
+
+def close_response(future) -> None:
+    if future.exception() is None:
+        future.result().close()
+
+
+class YahooSession:
+    """Keep-alive HTTP session with the Yahoo cookie and crumb set up once.
+
+    yahooquery runs the cookie/consent setup and fetches a new crumb every time
+    a Ticker is created. Tickers created through this session share its
+    connections and crumb instead, and the crumb is only refreshed after Yahoo
+    rejects it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session: requests.Session = initialize_session()
+        if YAHOO_BASE_URL:
+            logger.warning(f"Sending Yahoo requests to {YAHOO_BASE_URL}")
+        self.session.mount(
+            "https://",
+            YahooAdapter(
+                YAHOO_BASE_URL,
+                max_retries=DeadlineRetry(
+                    total=5,
+                    backoff_factor=0.3,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                ),
+                timeout=REQUEST_TIMEOUT,
+            ),
+        )
+        self.crumb: str | None = None
+        self.authenticate()
+
+    def authenticate(self) -> None:
+        """Set up the Yahoo cookies and fetch a new crumb."""
+        with self.lock:
+            self.session = setup_session(self.session)
+            self.crumb = get_crumb(self.session)
+        if self.crumb is None:
+            logger.error("Unable to obtain a Yahoo crumb")
+        else:
+            logger.info("Yahoo session authenticated")
+
+    def refresh_if_auth_error(self, response) -> bool:
+        """Refresh the crumb if the response is a Yahoo authentication error.
+
+        Args:
+            response: A yahooquery result, error messages are returned as strings.
+
+        Returns:
+            bool: True if the crumb was refreshed and the request should be retried.
+        """
+        if not isinstance(response, str):
+            return False
+        if not any(message in response.lower() for message in AUTH_ERROR_MESSAGES):
+            return False
+
+        logger.warning(f"Yahoo authentication error, refreshing crumb: {response}")
+        self.authenticate()
+        return True
+
+    def ticker(self, symbols) -> "SharedSessionTicker":
+        return SharedSessionTicker(symbols, self)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, **kwargs)
+
+
+class SharedSessionTicker(yahooquery.Ticker):
+    """yahooquery Ticker that uses a YahooSession instead of setting up its own."""
+
+    def __init__(self, symbols, yahoo_session: YahooSession):
+        # Skips yahooquery's __init__, which would set up a new session and crumb
+        self.yahoo_session = yahoo_session
+        self.country = "united states"
+        self.formatted = False
+        self.progress = False
+        self.username = None
+        self.password = None
+        self._setup_url = None
+        self.symbols = symbols
+        self.invalid_symbols = None
+
+    @property
+    def session(self) -> requests.Session:
+        return self.yahoo_session.session
+
+    @session.setter
+    def session(self, session: requests.Session) -> None:
+        self.yahoo_session.session = session
+
+    @property
+    def crumb(self) -> str | None:
+        return self.yahoo_session.crumb
+
+    @crumb.setter
+    def crumb(self, crumb: str | None) -> None:
+        self.yahoo_session.crumb = crumb
+
+
+_yahoo_session: YahooSession | None = None
+_yahoo_session_lock = threading.Lock()
+
+
+def get_yahoo_session() -> YahooSession:
+    """Return the process wide YahooSession, creating it on first use."""
+    global _yahoo_session
+    with _yahoo_session_lock:
+        if _yahoo_session is None:
+            _yahoo_session = YahooSession()
+        return _yahoo_session